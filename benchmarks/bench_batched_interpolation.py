@@ -0,0 +1,64 @@
+"""
+Compares the per-cell and batched gap inference paths of
+`interpolation_using_trained_model` on a synthetic monthly cube.
+
+Usage:
+    python benchmarks/bench_batched_interpolation.py --rows 40 --cols 60 --years 19
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from interpolation_using_trained_model import (  # noqa: E402
+    interpolate_missing_data_with_lstm,
+    interpolate_missing_data_with_lstm_batched,
+)
+from synthetic import make_synthetic_monthly_data  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--cols", type=int, default=30)
+    parser.add_argument("--years", type=int, default=19)
+    parser.add_argument("--sequence-length", type=int, default=6)
+    parser.add_argument("--batch-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    missing_indices = {1: 15, 2: 15, 7: 14, 8: 14}
+    monthly_data = make_synthetic_monthly_data(args.rows, args.cols, args.years, missing_indices)
+
+    model = tf.keras.Sequential([
+        tf.keras.layers.LSTM(50, activation='relu', input_shape=(args.sequence_length, 1)),
+        tf.keras.layers.Dense(1)
+    ])
+
+    start = time.perf_counter()
+    per_cell = interpolate_missing_data_with_lstm(model, monthly_data, missing_indices, args.sequence_length)
+    per_cell_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = interpolate_missing_data_with_lstm_batched(
+        model, monthly_data, missing_indices, args.sequence_length, batch_size=args.batch_size
+    )
+    batched_seconds = time.perf_counter() - start
+
+    for month in missing_indices:
+        np.testing.assert_allclose(batched[month], per_cell[month], rtol=1e-5, atol=1e-4)
+
+    cells = len(missing_indices) * args.rows * args.cols
+    print(f"Grid: {args.rows}x{args.cols}, {len(missing_indices)} missing months, {cells} cells")
+    print(f"Per-cell: {per_cell_seconds:.2f} s ({cells / per_cell_seconds:.0f} cells/s)")
+    print(f"Batched:  {batched_seconds:.2f} s ({cells / batched_seconds:.0f} cells/s)")
+    print(f"Speedup:  {per_cell_seconds / batched_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures peak memory of the float64 copy-based data path against the float32
+in-place path on a synthetic global-size grid.
+
+Each layout builds the monthly cubes, prepares the training sequences and fills
+the gaps; peak traced NumPy memory is reported per layout.
+
+Usage:
+    python benchmarks/bench_memory_layout.py --rows 720 --cols 1440 --years 19
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interpolation_using_trained_model import interpolate_missing_data_with_lstm_batched  # noqa: E402
+from prepare_train_test_data import prepare_sequences_for_all_months  # noqa: E402
+
+
+class WindowMeanModel:
+    """Stand-in for the LSTM that predicts the mean of each input window."""
+
+    def predict_on_batch(self, batch):
+        return batch.mean(axis=1)
+
+
+def run_layout(dtype, in_place, rows, cols, years, missing_indices, sequence_length, ocean_fraction):
+    """Runs ingestion-shaped allocation, sequence building and gap filling; returns peak MiB."""
+    rng = np.random.default_rng(0)
+    ocean = rng.random((rows, cols)) < ocean_fraction
+
+    tracemalloc.start()
+    monthly_data = {}
+    for month in range(1, 13):
+        array = np.full((rows, cols, years), np.nan, dtype=dtype)
+        array[~ocean] = rng.normal(0, 10, size=(int((~ocean).sum()), years)).astype(dtype)
+        if month in missing_indices:
+            array[:, :, missing_indices[month]] = np.nan
+        monthly_data[month] = array
+
+    sequences, targets = prepare_sequences_for_all_months(monthly_data, missing_indices, sequence_length, dtype=dtype)
+    interpolate_missing_data_with_lstm_batched(
+        WindowMeanModel(), monthly_data, missing_indices, sequence_length, in_place=in_place
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 ** 2, len(targets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=360)
+    parser.add_argument("--cols", type=int, default=720)
+    parser.add_argument("--years", type=int, default=19)
+    parser.add_argument("--sequence-length", type=int, default=6)
+    parser.add_argument("--ocean-fraction", type=float, default=0.7)
+    args = parser.parse_args()
+
+    missing_indices = {1: 15, 2: 15, 7: 14, 8: 14}
+    layouts = {
+        "float64 + copy": (np.float64, False),
+        "float32 + in place": (np.float32, True),
+    }
+
+    print(f"Grid: {args.rows}x{args.cols}x{args.years}, {len(missing_indices)} missing months")
+    peaks = {}
+    for name, (dtype, in_place) in layouts.items():
+        peak, n_samples = run_layout(
+            dtype, in_place, args.rows, args.cols, args.years, missing_indices,
+            args.sequence_length, args.ocean_fraction
+        )
+        peaks[name] = peak
+        print(f"{name:>20}: peak {peak:,.0f} MiB ({n_samples} training samples)")
+
+    print(f"Reduction: {peaks['float64 + copy'] / peaks['float32 + in place']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Measures point and region query latency of `timeseries_query.TimeSeriesStore`
+on a synthetic filled cube, against targets of 10 ms per point query and one
+second per region aggregate.
+
+Usage:
+    python benchmarks/bench_query_latency.py --rows 720 --cols 1440 --years 19 --output query.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import make_synthetic_monthly_data  # noqa: E402
+from timeseries_query import TimeSeriesStore, build_query_store, save_region_index  # noqa: E402
+
+POINT_TARGET_MS = 10
+REGION_TARGET_MS = 1000
+
+
+def latency_summary(seconds):
+    milliseconds = np.array(seconds) * 1000
+    return {
+        "queries": len(milliseconds),
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 3),
+        "p99_ms": round(float(np.percentile(milliseconds, 99)), 3),
+        "max_ms": round(float(milliseconds.max()), 3),
+    }
+
+
+def time_queries(function, queries):
+    seconds = []
+    for query in queries:
+        start = time.perf_counter()
+        function(*query)
+        seconds.append(time.perf_counter() - start)
+    return latency_summary(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=360)
+    parser.add_argument("--cols", type=int, default=720)
+    parser.add_argument("--years", type=int, default=19)
+    parser.add_argument("--ocean-fraction", type=float, default=0.3)
+    parser.add_argument("--regions", type=int, default=16, help="Regions as a square number of grid blocks.")
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--cache-tiles", type=int, default=256)
+    parser.add_argument("--output", help="Path of the JSON report (printed to stdout when omitted).")
+    args = parser.parse_args()
+
+    monthly_data = make_synthetic_monthly_data(args.rows, args.cols, args.years, ocean_fraction=args.ocean_fraction)
+    resolution = 0.25
+    transform = (resolution, 0.0, -180.0, 0.0, -resolution, 90.0)
+
+    side = int(np.sqrt(args.regions))
+    block_rows = np.arange(args.rows) * side // args.rows
+    block_cols = np.arange(args.cols) * side // args.cols
+    region_grid = (block_rows[:, np.newaxis] * side + block_cols[np.newaxis, :] + 1).astype(np.int32)
+    region_names = [f"region_{number}" for number in range(1, side * side + 1)]
+
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, args.rows, args.points)
+    cols = rng.integers(0, args.cols, args.points)
+    points = [(90.0 - (row + 0.5) * resolution, -180.0 + (col + 0.5) * resolution) for row, col in zip(rows, cols)]
+
+    with tempfile.TemporaryDirectory() as store_directory:
+        start = time.perf_counter()
+        build_query_store(store_directory, monthly_data, 2003, transform)
+        save_region_index(store_directory, region_grid, region_names)
+        build_seconds = time.perf_counter() - start
+        del monthly_data
+
+        store = TimeSeriesStore(store_directory, cache_tiles=args.cache_tiles)
+        cold_points = time_queries(store.point_series, points)
+        warm_points = time_queries(store.point_series, points)
+        cache = store.cache_info()
+
+        region_store = TimeSeriesStore(store_directory, cache_tiles=args.cache_tiles)
+        cold_regions = time_queries(region_store.region_series, [(name,) for name in region_names])
+        warm_regions = time_queries(region_store.region_series, [(name,) for name in region_names])
+
+    report = {
+        "grid": [args.rows, args.cols],
+        "months": args.years * 12,
+        "build_seconds": round(build_seconds, 3),
+        "point_cold": cold_points,
+        "point_warm": warm_points,
+        "cache": {"hits": cache.hits, "misses": cache.misses, "tiles": cache.currsize},
+        "region_cold": cold_regions,
+        "region_warm": warm_regions,
+        "point_target_met": cold_points["p99_ms"] < POINT_TARGET_MS,
+        "region_target_met": cold_regions["max_ms"] < REGION_TARGET_MS,
+    }
+    print(f"Point p99: {cold_points['p99_ms']:.3f} ms cold, {warm_points['p99_ms']:.3f} ms warm "
+          f"(target {POINT_TARGET_MS} ms)")
+    print(f"Region max: {cold_regions['max_ms']:.1f} ms cold, {warm_regions['max_ms']:.1f} ms warm "
+          f"(target {REGION_TARGET_MS} ms)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved benchmark report: {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Times and memory-profiles every pipeline stage on synthetic GRACE-like data.
+
+Stages: ingestion (create_monthly_3d_arrays_with_mask), sequence preparation
+(prepare_sequences_for_all_months), training (model.fit), gap inference
+(interpolate_missing_data_with_lstm_batched) and output
+(process_and_save_interpolated_data). Results are written as JSON, one record
+per grid size, so runs can be compared across commits.
+
+Usage:
+    python benchmarks/run_benchmarks.py --grid 40x60 --grid 120x240 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np  # noqa: E402
+
+from synthetic import (  # noqa: E402
+    make_missing_indices,
+    make_synthetic_monthly_data,
+    make_synthetic_shape,
+    synthetic_transform,
+    write_synthetic_tiffs,
+)
+
+START_YEAR = 2003
+
+
+def max_rss_mib():
+    """Peak resident set size of this process so far, in MiB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return usage / 1024 ** 2 if platform.system() == "Darwin" else usage / 1024
+
+
+def measure(stage, results, function, *args, **kwargs):
+    """Runs `function`, records wall time, traced peak memory and peak RSS under `stage`."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results[stage] = {
+        "seconds": round(seconds, 4),
+        "peak_traced_mib": round(peak / 1024 ** 2, 2),
+        "max_rss_mib": round(max_rss_mib(), 2),
+    }
+    print(f"  {stage:<12} {seconds:8.2f} s  {peak / 1024 ** 2:9.1f} MiB traced")
+    return output
+
+
+def run_grid(rows, cols, args, work_directory):
+    """Runs every stage on one synthetic grid and returns its benchmark record."""
+    from build_train_and_calculateloss import build_lstm_model
+    from create_monthly_arrays import create_monthly_3d_arrays_with_mask
+    from interpolation_using_trained_model import interpolate_missing_data_with_lstm_batched
+    from prepare_train_test_data import prepare_sequences_for_all_months
+    import plot_save_interpolated_data
+
+    missing_indices = make_missing_indices(args.years, args.gap_pattern)
+    source = make_synthetic_monthly_data(
+        rows, cols, args.years, missing_indices, ocean_fraction=args.ocean_fraction, nan_fraction=args.nan_fraction
+    )
+    transform = synthetic_transform()
+    tiff_directory = os.path.join(work_directory, "tiffs")
+    tiff_files, missing_files = write_synthetic_tiffs(tiff_directory, source, START_YEAR, transform)
+    shape = make_synthetic_shape(transform, (rows, cols))
+    del source
+
+    stages = {}
+    end_year = START_YEAR + args.years - 1
+    monthly_data = measure(
+        "ingest", stages, create_monthly_3d_arrays_with_mask,
+        tiff_files, missing_files, START_YEAR, end_year, tiff_directory, shape
+    )
+
+    sequences, targets = measure(
+        "sequences", stages, prepare_sequences_for_all_months, monthly_data, missing_indices, args.sequence_length
+    )
+
+    model = build_lstm_model((args.sequence_length, 1))
+    measure(
+        "fit", stages, model.fit, sequences[..., np.newaxis], targets,
+        epochs=args.epochs, batch_size=args.batch_size, validation_split=0.1, verbose=0
+    )
+
+    interpolated = measure(
+        "interpolate", stages, interpolate_missing_data_with_lstm_batched,
+        model, monthly_data, missing_indices, args.sequence_length
+    )
+
+    # The output stage reads its inputs from module-level settings
+    plot_save_interpolated_data.global_tws_file = os.path.join(tiff_directory, tiff_files[0])
+    plot_save_interpolated_data.output_directory = os.path.join(work_directory, "output")
+    plot_save_interpolated_data.missing_indices = missing_indices
+    plot_save_interpolated_data.interpolated_monthly_india_data = interpolated
+    measure("write", stages, plot_save_interpolated_data.process_and_save_interpolated_data)
+
+    return {
+        "grid": [rows, cols],
+        "years": args.years,
+        "gap_pattern": args.gap_pattern,
+        "ocean_fraction": args.ocean_fraction,
+        "nan_fraction": args.nan_fraction,
+        "n_training_samples": int(len(targets)),
+        "stages": stages,
+    }
+
+
+def parse_grid(value):
+    rows, cols = value.lower().split("x")
+    return int(rows), int(cols)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--grid", type=parse_grid, action="append",
+                        help="Grid size as ROWSxCOLS; repeat for several sizes (default 40x60).")
+    parser.add_argument("--years", type=int, default=19)
+    parser.add_argument("--gap-pattern", choices=["grace", "scattered"], default="grace")
+    parser.add_argument("--ocean-fraction", type=float, default=0.3)
+    parser.add_argument("--nan-fraction", type=float, default=0.01)
+    parser.add_argument("--sequence-length", type=int, default=6)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=150)
+    parser.add_argument("--output", help="Path of the JSON report (printed to stdout when omitted).")
+    args = parser.parse_args()
+
+    records = []
+    for rows, cols in args.grid or [(40, 60)]:
+        print(f"Grid {rows}x{cols}x{args.years}:")
+        with tempfile.TemporaryDirectory() as work_directory:
+            records.append(run_grid(rows, cols, args, work_directory))
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "results": records,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved benchmark report: {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Synthetic GRACE-like inputs for the benchmarks: monthly cubes, gap patterns,
+monthly GeoTIFFs named like the CSR mascon files, and a mask shape.
+"""
+import os
+
+import numpy as np
+
+NODATA = -12417.8330078125
+
+
+def make_missing_indices(years, pattern="grace", seed=0):
+    """
+    Builds a {month: year_index} gap configuration.
+
+    Parameters:
+    ----------
+    years : int
+        Number of years in the record.
+    pattern : str, optional
+        "grace" mimics the 2017-2018 GRACE/GRACE-FO gap near the end of the record
+        (July-December of one year and January-May of the next); "scattered" picks
+        one random year for every month.
+    seed : int, optional
+        Seed for the "scattered" pattern.
+
+    Returns:
+    -------
+    dict
+        A dictionary where keys are months (1-12) and values are year indices.
+    """
+    if pattern == "grace":
+        first_gap_year = max(years - 5, 0)
+        missing_indices = {month: first_gap_year for month in range(7, 13)}
+        missing_indices.update({month: min(first_gap_year + 1, years - 1) for month in range(1, 6)})
+        return missing_indices
+    if pattern == "scattered":
+        rng = np.random.default_rng(seed)
+        return {month: int(rng.integers(0, years)) for month in range(1, 13)}
+    raise ValueError(f"Unknown gap pattern '{pattern}', expected 'grace' or 'scattered'.")
+
+
+def make_synthetic_monthly_data(rows, cols, years, missing_indices=None, ocean_fraction=0.0, nan_fraction=0.0,
+                                dtype=np.float32, seed=0):
+    """
+    Builds a dict of (rows, cols, years) TWSA-like cubes.
+
+    Every land cell gets a declining trend, a seasonal offset and noise; ocean cells
+    are NaN in every year, `nan_fraction` of the remaining values are scattered NaNs,
+    and the year at each month's missing index is NaN everywhere.
+
+    Returns:
+    -------
+    dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays.
+    """
+    rng = np.random.default_rng(seed)
+    ocean = rng.random((rows, cols)) < ocean_fraction
+    base = rng.normal(0, 10, size=(rows, cols, 1))
+    trend = np.linspace(0, -rng.uniform(5, 40), years)
+
+    monthly_data = {}
+    for month in range(1, 13):
+        seasonal = 15 * np.sin(2 * np.pi * month / 12)
+        array = (base + trend + seasonal + rng.normal(0, 3, size=(rows, cols, years))).astype(dtype)
+        array[ocean] = np.nan
+        if nan_fraction:
+            array[rng.random(array.shape) < nan_fraction] = np.nan
+        if missing_indices and month in missing_indices:
+            array[:, :, missing_indices[month]] = np.nan
+        monthly_data[month] = array
+    return monthly_data
+
+
+def synthetic_transform(west=60.0, north=38.0, resolution=0.25):
+    """Returns the affine transform of a north-up 0.25 degree grid, like the CSR mascon TIFFs."""
+    from rasterio.transform import from_origin
+
+    return from_origin(west, north, resolution, resolution)
+
+
+def write_synthetic_tiffs(directory, monthly_data, start_year, transform, crs="EPSG:4326"):
+    """
+    Writes one GeoTIFF per available (year, month) using the CSR mascon file names.
+
+    Months whose slice is NaN everywhere are treated as gaps and not written.
+
+    Returns:
+    -------
+    tuple
+        Sorted names of the written files and names of the skipped (missing) files.
+    """
+    import rasterio
+
+    os.makedirs(directory, exist_ok=True)
+    tiff_files = []
+    missing_files = []
+    for month, array in monthly_data.items():
+        for year_index in range(array.shape[2]):
+            filename = f"TWSA_{start_year + year_index}{month:02d}_cm_CSR_0.25_MASCON_LM.tif"
+            data = array[:, :, year_index]
+            if np.isnan(data).all():
+                missing_files.append(filename)
+                continue
+
+            with rasterio.open(
+                os.path.join(directory, filename), "w", driver="GTiff", height=data.shape[0],
+                width=data.shape[1], count=1, dtype="float32", crs=crs, transform=transform, nodata=NODATA,
+            ) as dst:
+                dst.write(np.where(np.isnan(data), NODATA, data).astype(np.float32), 1)
+            tiff_files.append(filename)
+    return sorted(tiff_files), sorted(missing_files)
+
+
+def make_synthetic_shape(transform, shape, crs="EPSG:4326", coverage=0.8):
+    """
+    Returns a GeoDataFrame with one irregular polygon inside the grid, used as the mask.
+
+    The polygon is a circle through the grid center with a notch cut out of it, so the
+    mask is not a plain rectangle.
+    """
+    import geopandas as gpd
+    from shapely.geometry import Point, box
+
+    rows, cols = shape
+    west, north = transform * (0, 0)
+    east, south = transform * (cols, rows)
+    center = Point((west + east) / 2, (north + south) / 2)
+    radius = coverage * min(east - west, north - south) / 2
+    notch = box(center.x, center.y, center.x + radius, center.y + radius)
+    return gpd.GeoDataFrame(geometry=[center.buffer(radius).difference(notch)], crs=crs)
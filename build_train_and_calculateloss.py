@@ -1,7 +1,11 @@
 import numpy as np
 import tensorflow as tf
 
-def build_lstm_model(input_shape):
+from evaluation import evaluate_model, summarize_in_batches
+from numpy_lstm import NumpyLSTMModel, export_lstm_weights, verify_against_keras
+from prepare_train_test_data import make_streaming_datasets
+
+def build_lstm_model(input_shape, units=50):
     """
     Builds and compiles an LSTM model for time-series regression tasks.
 
@@ -9,6 +13,8 @@ def build_lstm_model(input_shape):
     ----------
     input_shape : tuple
         Shape of the input data (sequence_length, num_features).
+    units : int, optional
+        Number of LSTM units.
 
     Returns:
     -------
@@ -16,71 +22,135 @@ def build_lstm_model(input_shape):
         A compiled LSTM model.
     """
     model = tf.keras.Sequential([
-        tf.keras.layers.LSTM(50, activation='relu', input_shape=input_shape),
+        tf.keras.layers.LSTM(units, activation='relu', input_shape=input_shape),
         tf.keras.layers.Dense(1)  # Output layer for regression
     ])
     model.compile(optimizer='adam', loss='mean_squared_error', metrics=['mae'])
     return model
 
 
-# Build and summarize the LSTM model
-input_shape = (X_train.shape[1], X_train.shape[2])  # (sequence_length, num_features)
-model = build_lstm_model(input_shape)
-model.summary()
-
-# Train the model
-history = model.fit(
-    X_train, y_train,
-    epochs=50,
-    batch_size=150,
-    validation_split=0.1
-)
-
-# Extract loss and metrics
-train_loss = history.history['loss'][-1]
-train_mae = history.history['mae'][-1]
-val_loss = history.history['val_loss'][-1]
-val_mae = history.history['val_mae'][-1]
-
-# Assuming max and min values of the dataset (replace with pre-computed values if known)
-max_value = np.max(all_sequences)
-min_value = np.min(all_sequences)
-range_value = max_value - min_value
-
-# Normalize metrics by the maximum value
-normalized_loss = train_loss / max_value
-normalized_mae = train_mae / max_value
-normalized_val_loss = val_loss / max_value
-normalized_val_mae = val_mae / max_value
-
-# Convert normalized metrics to percentages
-percentage_loss = normalized_loss * 100
-percentage_mae = normalized_mae * 100
-percentage_val_loss = normalized_val_loss * 100
-percentage_val_mae = normalized_val_mae * 100
-
-# Display normalized and percentage metrics
-print("\n--- Normalized Metrics (by Max Value) ---")
-print(f"Normalized Loss: {normalized_loss:.4f}, Percentage Loss: {percentage_loss:.2f}%")
-print(f"Normalized MAE: {normalized_mae:.4f}, Percentage MAE: {percentage_mae:.2f}%")
-print(f"Normalized Val Loss: {normalized_val_loss:.4f}, Percentage Val Loss: {percentage_val_loss:.2f}%")
-print(f"Normalized Val MAE: {normalized_val_mae:.4f}, Percentage Val MAE: {percentage_val_mae:.2f}%")
-
-# Normalize metrics by the range of the dataset
-normalized_loss_by_range = train_loss / range_value
-normalized_mae_by_range = train_mae / range_value
-normalized_val_loss_by_range = val_loss / range_value
-normalized_val_mae_by_range = val_mae / range_value
-
-# Convert normalized metrics (by range) to percentages
-percentage_loss_by_range = normalized_loss_by_range * 100
-percentage_mae_by_range = normalized_mae_by_range * 100
-percentage_val_loss_by_range = normalized_val_loss_by_range * 100
-percentage_val_mae_by_range = normalized_val_mae_by_range * 100
-
-# Display normalized and percentage metrics (by range)
-print("\n--- Normalized Metrics (by Range) ---")
-print(f"Normalized Loss (by Range): {normalized_loss_by_range:.4f}, Percentage Loss (by Range): {percentage_loss_by_range:.2f}%")
-print(f"Normalized MAE (by Range): {normalized_mae_by_range:.4f}, Percentage MAE (by Range): {percentage_mae_by_range:.2f}%")
-print(f"Normalized Val Loss (by Range): {normalized_val_loss_by_range:.4f}, Percentage Val Loss (by Range): {percentage_val_loss_by_range:.2f}%")
-print(f"Normalized Val MAE (by Range): {normalized_val_mae_by_range:.4f}, Percentage Val MAE (by Range): {percentage_val_mae_by_range:.2f}%")
+def train_lstm_model_streaming(monthly_data, missing_indices, sequence_length, epochs=50, batch_size=150,
+                               validation_fraction=0.1, shuffle_buffer=100000, valid_cells=None):
+    """
+    Builds and trains the LSTM model from lazily generated batches.
+
+    Unlike fitting on `X_train`, the sequences are never materialised as a whole,
+    so training memory stays bounded by the shuffle buffer regardless of grid size.
+
+    Parameters:
+    ----------
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    missing_indices : dict
+        A dictionary where keys are months (1-12) and values are the time index to exclude.
+    sequence_length : int
+        The length of each input sequence.
+    epochs : int, optional
+        Number of training epochs.
+    batch_size : int, optional
+        Number of samples per training batch.
+    validation_fraction : float, optional
+        Fraction of grid cells held out for validation.
+    shuffle_buffer : int, optional
+        Maximum number of samples shuffled together.
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to train on. All cells are used when omitted.
+
+    Returns:
+    -------
+    tuple
+        The trained model and its `History` object.
+    """
+    train_dataset, validation_dataset = make_streaming_datasets(
+        monthly_data, missing_indices, sequence_length, batch_size=batch_size,
+        validation_fraction=validation_fraction, shuffle_buffer=shuffle_buffer, valid_cells=valid_cells
+    )
+    model = build_lstm_model((sequence_length, 1))
+    history = model.fit(train_dataset, epochs=epochs, validation_data=validation_dataset)
+    return model, history
+
+
+if __name__ == "__main__":
+    import json
+    import os
+
+    from training_harness import train_with_harness, training_fingerprint
+
+    # Train the model with a JSON training log, early stopping and checkpoints.
+    # Checkpoints are kept per training set and settings, so rerunning after an
+    # interruption resumes from the latest checkpoint while new data starts fresh.
+    # Pass batch_size="auto" to autotune the batch size.
+    settings = {"epochs": 50, "batch_size": 150, "validation_split": 0.1}
+    checkpoint_directory = os.path.join(
+        "training_checkpoints", training_fingerprint(X_train, y_train, **settings)[:16]
+    )
+    model, history = train_with_harness(X_train, y_train, checkpoint_directory, **settings)
+    model.summary()
+
+    # Export the weights for TensorFlow-free inference and check both backends agree
+    export_lstm_weights(model, "lstm_weights.npz")
+    verify_against_keras(model, NumpyLSTMModel.load("lstm_weights.npz"), X_test[:1000])
+
+    # Extract loss and metrics of the last epoch from the training log, which also covers resumed runs
+    with open(os.path.join(checkpoint_directory, "training_log.json")) as f:
+        last_epoch = json.load(f)["epochs"][-1]
+    train_loss = last_epoch['loss']
+    train_mae = last_epoch['mae']
+    val_loss = last_epoch['val_loss']
+    val_mae = last_epoch['val_mae']
+
+    # Max and min of the dataset from a single streaming pass
+    sequence_stats = summarize_in_batches(all_sequences)
+    max_value = sequence_stats.max
+    min_value = sequence_stats.min
+    range_value = max_value - min_value
+
+    # Normalize metrics by the maximum value
+    normalized_loss = train_loss / max_value
+    normalized_mae = train_mae / max_value
+    normalized_val_loss = val_loss / max_value
+    normalized_val_mae = val_mae / max_value
+
+    # Convert normalized metrics to percentages
+    percentage_loss = normalized_loss * 100
+    percentage_mae = normalized_mae * 100
+    percentage_val_loss = normalized_val_loss * 100
+    percentage_val_mae = normalized_val_mae * 100
+
+    # Display normalized and percentage metrics
+    print("\n--- Normalized Metrics (by Max Value) ---")
+    print(f"Normalized Loss: {normalized_loss:.4f}, Percentage Loss: {percentage_loss:.2f}%")
+    print(f"Normalized MAE: {normalized_mae:.4f}, Percentage MAE: {percentage_mae:.2f}%")
+    print(f"Normalized Val Loss: {normalized_val_loss:.4f}, Percentage Val Loss: {percentage_val_loss:.2f}%")
+    print(f"Normalized Val MAE: {normalized_val_mae:.4f}, Percentage Val MAE: {percentage_val_mae:.2f}%")
+
+    # Normalize metrics by the range of the dataset
+    normalized_loss_by_range = train_loss / range_value
+    normalized_mae_by_range = train_mae / range_value
+    normalized_val_loss_by_range = val_loss / range_value
+    normalized_val_mae_by_range = val_mae / range_value
+
+    # Convert normalized metrics (by range) to percentages
+    percentage_loss_by_range = normalized_loss_by_range * 100
+    percentage_mae_by_range = normalized_mae_by_range * 100
+    percentage_val_loss_by_range = normalized_val_loss_by_range * 100
+    percentage_val_mae_by_range = normalized_val_mae_by_range * 100
+
+    # Display normalized and percentage metrics (by range)
+    print("\n--- Normalized Metrics (by Range) ---")
+    print(f"Normalized Loss (by Range): {normalized_loss_by_range:.4f}, Percentage Loss (by Range): {percentage_loss_by_range:.2f}%")
+    print(f"Normalized MAE (by Range): {normalized_mae_by_range:.4f}, Percentage MAE (by Range): {percentage_mae_by_range:.2f}%")
+    print(f"Normalized Val Loss (by Range): {normalized_val_loss_by_range:.4f}, Percentage Val Loss (by Range): {percentage_val_loss_by_range:.2f}%")
+    print(f"Normalized Val MAE (by Range): {normalized_val_mae_by_range:.4f}, Percentage Val MAE (by Range): {percentage_val_mae_by_range:.2f}%")
+
+    # Evaluate the held-out set in one pass, with per-cell and per-month error maps
+    grid_shape = monthly_india_3d_arrays[1].shape[:2]  # Placeholder for the monthly 3D data dictionary
+    evaluation = evaluate_model(model, X_test, y_test, cells=cells_test, months=months_test, grid_shape=grid_shape)
+    print("\n--- Test Metrics ---")
+    print(f"Test MAE: {evaluation['mae']:.4f}, Test RMSE: {evaluation['rmse']:.4f}, Test Bias: {evaluation['bias']:.4f}")
+    print(f"Test targets: mean {evaluation['targets']['mean']:.4f}, std {evaluation['targets']['std']:.4f}")
+    np.savez_compressed(
+        "test_error_maps.npz", cell_mae=evaluation["cell_mae"], cell_rmse=evaluation["cell_rmse"],
+        month_mae=evaluation["month_mae"]
+    )
+    print("Saved per-cell and per-month test error maps: test_error_maps.npz")
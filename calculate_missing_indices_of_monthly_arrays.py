@@ -1,3 +1,9 @@
+import os
+import re
+
+import numpy as np
+
+
 def calculate_missing_indices(start_year, end_year, missing_years):
     """
     Calculate the missing indices for each month, given the start year, end year, and missing years.
@@ -9,12 +15,14 @@ def calculate_missing_indices(start_year, end_year, missing_years):
     end_year : int
         The last year of the dataset.
     missing_years : dict
-        A dictionary where keys are months (1-12) and values are the years with missing data.
+        A dictionary where keys are months (1-12) and values are the year, or a list of
+        years, with missing data.
 
     Returns:
     -------
     dict
-        A dictionary where keys are months (1-12) and values are the missing indices.
+        A dictionary where keys are months (1-12) and values are lists of missing indices,
+        one per missing year (a single year gives a one-element list).
     
     Raises:
     ------
@@ -27,21 +35,118 @@ def calculate_missing_indices(start_year, end_year, missing_years):
     # Calculate the total number of years in the dataset
     total_years = end_year - start_year + 1
 
-    for month, missing_year in missing_years.items():
-        # Calculate the index of the missing year relative to `start_year`
-        missing_index = missing_year - start_year
+    for month, years in missing_years.items():
+        month_indices = []
+        for missing_year in np.atleast_1d(years).tolist():
+            # Calculate the index of the missing year relative to `start_year`
+            missing_index = missing_year - start_year
+
+            # Ensure the missing index is within the valid range
+            if 0 <= missing_index < total_years:
+                month_indices.append(missing_index)
+            else:
+                raise ValueError(
+                    f"Missing year {missing_year} for month {month} is out of the data range {start_year}-{end_year}"
+                )
 
-        # Ensure the missing index is within the valid range
-        if 0 <= missing_index < total_years:
-            missing_indices[month] = missing_index
-        else:
-            raise ValueError(
-                f"Missing year {missing_year} for month {month} is out of the data range {start_year}-{end_year}"
-            )
+        missing_indices[month] = month_indices
 
     return missing_indices
 
 
+def build_availability_matrix(tiff_files, start_year, end_year, monthly_arrays=None,
+                              filename_pattern=r"TWSA_(\d{4})(\d{2})_"):
+    """
+    Build a boolean (month, year) availability matrix from the TIFF listing and, optionally, the ingested cube.
+
+    Parameters:
+    ----------
+    tiff_files : list
+        Names of the monthly TIFF files.
+    start_year : int
+        The first year of the dataset.
+    end_year : int
+        The last year of the dataset.
+    monthly_arrays : dict, optional
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, year).
+        When given, a (month, year) whose slice has no finite value is also marked missing.
+    filename_pattern : str, optional
+        Regular expression capturing the year and month of a file name.
+
+    Returns:
+    -------
+    np.ndarray
+        A boolean array of shape (12, end_year - start_year + 1); row `month - 1` is True
+        for every year in which that month is available.
+    """
+    total_years = end_year - start_year + 1
+    availability = np.zeros((12, total_years), dtype=bool)
+
+    pattern = re.compile(filename_pattern)
+    dates = [match.groups() for match in map(pattern.search, tiff_files) if match]
+    if dates:
+        years, months = np.array(dates, dtype=int).T
+        in_range = (years >= start_year) & (years <= end_year) & (months >= 1) & (months <= 12)
+        availability[months[in_range] - 1, years[in_range] - start_year] = True
+
+    if monthly_arrays is not None:
+        for month, array in monthly_arrays.items():
+            availability[month - 1] &= np.isfinite(array).any(axis=(0, 1))
+
+    return availability
+
+
+def mark_unpublished_months_available(availability):
+    """
+    Marks every (month, year) after the latest available one as available.
+
+    Months after the last published file are not released yet rather than missing,
+    so they must not be reported (and filled) as gaps.
+
+    Parameters:
+    ----------
+    availability : np.ndarray
+        Boolean (12, years) matrix from `build_availability_matrix`.
+
+    Returns:
+    -------
+    np.ndarray
+        A copy of `availability` with the trailing unpublished months set to True.
+    """
+    # Position of each (month, year) in calendar order
+    calendar_position = np.arange(availability.shape[1])[np.newaxis, :] * 12 + np.arange(12)[:, np.newaxis]
+    last_available = calendar_position[availability].max() if availability.any() else -1
+    return availability | (calendar_position > last_available)
+
+
+def missing_indices_from_availability(availability):
+    """
+    Convert an availability matrix into missing indices for every month with gaps.
+
+    Parameters:
+    ----------
+    availability : np.ndarray
+        Boolean (12, years) matrix from `build_availability_matrix`.
+
+    Returns:
+    -------
+    dict
+        A dictionary where keys are months (1-12) and values are lists of missing indices.
+    """
+    months, indices = np.nonzero(~availability)
+    missing_indices = {}
+    for month, missing_index in zip(months.tolist(), indices.tolist()):
+        missing_indices.setdefault(month + 1, []).append(missing_index)
+    return missing_indices
+
+
+def iter_missing_indices(missing_indices):
+    """Yield (month, missing_index) pairs from a dict whose values are an index or a list of indices."""
+    for month, indices in missing_indices.items():
+        for missing_index in np.atleast_1d(indices).tolist():
+            yield month, missing_index
+
+
 # Example usage
 if __name__ == "__main__":
     # Define the start and end years of the dataset
@@ -60,3 +165,10 @@ if __name__ == "__main__":
         print("Missing indices:", missing_indices)
     except ValueError as e:
         print(f"Error: {e}")
+
+    # Or detect every gap from the directory listing (any number of gaps per month)
+    tiff_directory = "dummy/path/GRACE_DATA/TIFFs"
+    if os.path.isdir(tiff_directory):
+        availability = build_availability_matrix(os.listdir(tiff_directory), start_year, end_year)
+        availability = mark_unpublished_months_available(availability)
+        print("Detected missing indices:", missing_indices_from_availability(availability))
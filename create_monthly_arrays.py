@@ -1,9 +1,8 @@
 import rasterio
 import numpy as np
 import os
-import geopandas as gpd
-from rasterio.mask import mask
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rasterio.mask import raster_geometry_mask
 
 
 def read_tiff_to_array(tiff_path):
@@ -12,28 +11,75 @@ def read_tiff_to_array(tiff_path):
         return src.read(1)  # Read the first band
 
 
-def get_shape_of_first_tiff(tiff_files, tiff_directory, india_shape):
-    """Determines the shape of arrays from the first valid TIFF file."""
+def prepare_mask_window(tiff_files, tiff_directory, india_shape):
+    """
+    Reprojects the shapefile and rasterizes it once against the shared grid.
+
+    Returns the crop window, its boolean mask (True outside the shapes) and the
+    nodata value of the first valid TIFF, so every monthly file can be read with a
+    plain windowed read instead of re-running the mask.
+    """
     for file in tiff_files:
         file_path = os.path.join(tiff_directory, file)
         try:
             with rasterio.open(file_path) as src:
-                india_shape = india_shape.to_crs(src.crs)  # Match CRS
-                out_image, _ = mask(src, india_shape.geometry, crop=True, filled=True)
-                if out_image.size > 0:
-                    return out_image[0].shape
+                india_geom = india_shape.to_crs(src.crs).geometry
+                outside_mask, _, window = raster_geometry_mask(src, india_geom, crop=True)
+                if outside_mask.size > 0:
+                    return window, outside_mask, src.nodata
         except rasterio.errors.RasterioIOError as e:
             print(f"Error reading file {file_path}: {e}")
             continue
     raise FileNotFoundError("No valid TIFF files found to determine array shape.")
 
 
+def read_masked_window(file_path, window, outside_mask, nodata, dtype=np.float32):
+    """Reads the masked window of a single-band TIFF, with nodata and outside pixels set to NaN."""
+    with rasterio.open(file_path) as src:
+        raw = src.read(1, window=window)
+    invalid = outside_mask if nodata is None else outside_mask | (raw == nodata)
+    array = raw.astype(dtype)
+    array[invalid] = np.nan
+    return array
+
+
+def save_monthly_plots(monthly_arrays, start_year, plot_directory):
+    """Saves a PNG of every available month in the monthly 3D arrays."""
+    # Imported here so ingestion without plots does not load matplotlib
+    import matplotlib.pyplot as plt
+
+    for month, array in monthly_arrays.items():
+        for year_index in range(array.shape[2]):
+            data = array[:, :, year_index]
+            if np.isnan(data).all():
+                continue
+
+            year = start_year + year_index
+            plt.figure(figsize=(10, 6))
+            plt.imshow(data, cmap="viridis", interpolation="nearest", vmin=-250, vmax=50)
+            plt.colorbar(label="TWSA")
+            plt.title(f"TWSA for India {year}-{month:02d}")
+            plt.xlabel("Longitude")
+            plt.ylabel("Latitude")
+            plot_save_path = os.path.join(plot_directory, f"India_TWSA_{year}_{month:02d}.png")
+            plt.savefig(plot_save_path)
+            plt.close()
+
+
 def create_monthly_3d_arrays_with_mask(
-    tiff_files, missing_files, start_year, end_year, tiff_directory, india_shape
+    tiff_files, missing_files, start_year, end_year, tiff_directory, india_shape,
+    max_workers=8, plot_directory=None, dtype=np.float32
 ):
-    """Creates 3D arrays for monthly data with masking for India."""
+    """
+    Creates 3D arrays for monthly data with masking for India.
+
+    The shapefile is reprojected and rasterized once, and the monthly TIFFs are
+    read concurrently with `max_workers` threads. Plots are only written when
+    `plot_directory` is given, after all files have been read. The arrays are
+    allocated as `dtype` (float32 by default; pass np.float64 for the old layout).
+    """
     try:
-        array_shape = get_shape_of_first_tiff(tiff_files, tiff_directory, india_shape)
+        window, outside_mask, nodata = prepare_mask_window(tiff_files, tiff_directory, india_shape)
     except FileNotFoundError as e:
         print(e)
         return
@@ -41,56 +87,55 @@ def create_monthly_3d_arrays_with_mask(
     # Initialize 3D arrays with NaNs
     total_years = end_year - start_year + 1
     monthly_arrays = {
-        month: np.full((array_shape[0], array_shape[1], total_years), np.nan)
+        month: np.full((outside_mask.shape[0], outside_mask.shape[1], total_years), np.nan, dtype=dtype)
         for month in range(1, 13)
     }
 
     # Convert missing files to a set for faster lookup
     missing_files_set = set(missing_files)
 
+    jobs = {}
     for year in range(start_year, end_year + 1):
         for month in range(1, 13):
             filename = f"TWSA_{year}{month:02d}_cm_CSR_0.25_MASCON_LM.tif"
             file_path = os.path.join(tiff_directory, filename)
-            year_index = year - start_year  # Calculate the year index
 
             if filename in missing_files_set:
                 print(f"Skipping missing file: {filename}")
                 continue  # Skip if the file is missing
 
             if os.path.exists(file_path):
-                try:
-                    with rasterio.open(file_path) as src:
-                        india_shape = india_shape.to_crs(src.crs)
-                        india_geom = [feature["geometry"] for feature in india_shape.__geo_interface__["features"]]
-                        out_image, _ = mask(src, india_geom, crop=True)
-
-                        # Extract the array and handle nodata values
-                        array = out_image[0]
-                        array = np.ma.masked_where(array == src.nodata, array)
-
-                        # Save a plot of the masked data (optional)
-                        plt.figure(figsize=(10, 6))
-                        plt.imshow(array, cmap="viridis", interpolation="nearest", vmin=-250, vmax=50)
-                        plt.colorbar(label="TWSA")
-                        plt.title(f"TWSA for India {year}-{month:02d}")
-                        plt.xlabel("Longitude")
-                        plt.ylabel("Latitude")
-                        plot_save_path = os.path.join("dummy/output/path", f"India_TWSA_{year}_{month:02d}.png")
-                        plt.savefig(plot_save_path)
-                        plt.close()
-
-                        # Store the array in the correct position
-                        monthly_arrays[month][:, :, year_index] = array.filled(np.nan)
-
-                except rasterio.errors.RasterioIOError as e:
-                    print(f"Error reading file {file_path}: {e}")
-                    continue  # Skip if the file cannot be opened
+                jobs[file_path] = (month, year - start_year)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(read_masked_window, file_path, window, outside_mask, nodata, dtype): file_path
+            for file_path in jobs
+        }
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                array = future.result()
+            except rasterio.errors.RasterioIOError as e:
+                print(f"Error reading file {file_path}: {e}")
+                continue  # Skip if the file cannot be opened
+
+            # Store the array in the correct position
+            month, year_index = jobs[file_path]
+            monthly_arrays[month][:, :, year_index] = array
+
+    if plot_directory is not None:
+        save_monthly_plots(monthly_arrays, start_year, plot_directory)
 
     return monthly_arrays
 
 
 if __name__ == "__main__":
+    import geopandas as gpd
+
+    from cube_layout import build_valid_cell_index
+    from monthly_array_cache import load_or_create_monthly_arrays
+
     # Dummy file paths and variables
     india_shapefile_path = "dummy/path/India_Shapefiles/Indian_States.shp"
     tiff_directory = "dummy/path/GRACE_DATA/TIFFs"
@@ -102,12 +147,18 @@ if __name__ == "__main__":
     # List of TIFF files in the directory
     tiff_files = sorted([file for file in os.listdir(tiff_directory) if file.endswith(".tif")])
 
-    # Create 3D arrays for monthly data
-    monthly_india_3d_arrays = create_monthly_3d_arrays_with_mask(
-        tiff_files, missing_files, 2003, 2021, tiff_directory, india_shape
+    # Create 3D arrays for monthly data, reusing the on-disk cache when the inputs are unchanged
+    monthly_india_3d_arrays = load_or_create_monthly_arrays(
+        tiff_files, missing_files, 2003, 2021, tiff_directory, india_shape,
+        cache_root="dummy/path/cache", plot_directory="dummy/output/path"
     )
 
     # Print the shapes of the 3D arrays
     if monthly_india_3d_arrays:
         for month in range(1, 13):
             print(f"Shape of the 3D array for month {month:02d}: {monthly_india_3d_arrays[month].shape}")
+
+        # Report how much of the bounding box holds data (the index is stored with the cache entry)
+        valid_cells = build_valid_cell_index(monthly_india_3d_arrays)
+        n_cells = monthly_india_3d_arrays[1].shape[0] * monthly_india_3d_arrays[1].shape[1]
+        print(f"Valid cells: {len(valid_cells)}/{n_cells} ({100 * len(valid_cells) / n_cells:.1f}%)")
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def as_cell_time_matrix(array, writable=False):
+    """
+    Returns a (cell, time) view of a (x, y, time) monthly array.
+
+    Cells are numbered in row-major order (x * n_y + y), so each row of the matrix is
+    the contiguous time series of one grid cell. The sequence builder and the gap
+    inference both index this layout, and no copy is made for C-contiguous arrays
+    such as the ones produced by ingestion or opened from the cube cache.
+
+    Parameters:
+    ----------
+    array : np.ndarray
+        A 3D array (x, y, time-index).
+    writable : bool, optional
+        The caller writes through the matrix; raise instead of returning a copy
+        whose changes would be lost.
+
+    Returns:
+    -------
+    np.ndarray
+        A 2D array (x * y, time-index) sharing memory with `array` when possible.
+
+    Raises:
+    ------
+    ValueError
+        If `writable` is True and `array` cannot be viewed as a (cell, time) matrix.
+    """
+    matrix = array.reshape(-1, array.shape[-1])
+    if not np.may_share_memory(matrix, array):
+        if writable:
+            raise ValueError("Monthly array is not C-contiguous; cannot write through a (cell, time) view.")
+        print("Warning: monthly array is not C-contiguous; the (cell, time) matrix is a copy.")
+    return matrix
+
+
+def build_valid_cell_index(monthly_arrays):
+    """
+    Finds the grid cells that hold any finite value in any month or year.
+
+    Cells outside the mask (ocean, or outside the shapefile) are NaN everywhere and
+    can be skipped by sequence building and inference.
+
+    Parameters:
+    ----------
+    monthly_arrays : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+
+    Returns:
+    -------
+    np.ndarray
+        Sorted flat (cell, time) row indices of the valid cells, as int64.
+    """
+    valid = None
+    for array in monthly_arrays.values():
+        month_valid = np.isfinite(as_cell_time_matrix(array)).any(axis=1)
+        valid = month_valid if valid is None else valid | month_valid
+    return np.flatnonzero(valid).astype(np.int64)
+
+
+def save_valid_cell_index(path, valid_cells, grid_shape):
+    """Saves a valid-cell index together with the (x, y) grid shape it refers to."""
+    np.savez(path, valid_cells=valid_cells, grid_shape=np.asarray(grid_shape))
+
+
+def load_valid_cell_index(path):
+    """
+    Loads a valid-cell index written by `save_valid_cell_index`.
+
+    Returns:
+    -------
+    tuple
+        The flat valid-cell indices and the (x, y) grid shape.
+    """
+    with np.load(path) as index:
+        return index["valid_cells"], tuple(index["grid_shape"])
@@ -0,0 +1,170 @@
+import numpy as np
+
+
+class StreamingStats:
+    """
+    Running count, mean, variance, minimum and maximum, updated one batch at a time.
+
+    Batches are merged with the parallel form of Welford's algorithm, so the result
+    matches a single pass over the concatenated data without ever holding it all.
+    NaNs are ignored.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """Adds a batch of values (any shape) to the statistics."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+
+        batch_count = values.size
+        batch_mean = values.mean()
+        batch_m2 = np.square(values - batch_mean).sum()
+
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_count / total
+        self.m2 += batch_m2 + delta ** 2 * self.count * batch_count / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def as_dict(self):
+        return {
+            "count": int(self.count),
+            "mean": float(self.mean) if self.count else np.nan,
+            "std": float(self.std),
+            "min": float(self.min) if self.count else np.nan,
+            "max": float(self.max) if self.count else np.nan,
+        }
+
+
+def summarize_in_batches(array, batch_size=1_000_000):
+    """
+    Computes `StreamingStats` of an array (or memmap) in one pass over row batches.
+
+    Parameters:
+    ----------
+    array : np.ndarray
+        Array of any shape; batches are taken along the first axis.
+    batch_size : int, optional
+        Number of rows read per batch.
+
+    Returns:
+    -------
+    StreamingStats
+        The statistics of every value in `array`.
+    """
+    stats = StreamingStats()
+    for start in range(0, len(array), batch_size):
+        stats.update(array[start:start + batch_size])
+    return stats
+
+
+def evaluate_model(model, sequences, targets, cells=None, months=None, grid_shape=None, batch_size=65536):
+    """
+    Evaluates the model on a held-out set in one streaming pass.
+
+    Each batch is predicted once and folded into the error sums, the target and
+    prediction statistics and, when cell indices are given, per-cell and per-month
+    error accumulators (via `np.bincount`), so no full-array scan is repeated.
+
+    Parameters:
+    ----------
+    model : tf.keras.Model or NumpyLSTMModel
+        Model exposing `predict_on_batch`.
+    sequences : np.ndarray
+        Input sequences of shape (n_samples, sequence_length) or (n_samples, sequence_length, 1).
+    targets : np.ndarray
+        Target values of shape (n_samples,).
+    cells : np.ndarray, optional
+        Flat cell index of every sample (see `prepare_sequences_for_all_months(return_index=True)`).
+    months : np.ndarray, optional
+        Month (1-12) of every sample.
+    grid_shape : tuple, optional
+        (x, y) shape of the grid; required for the error maps.
+    batch_size : int, optional
+        Number of samples predicted per call.
+
+    Returns:
+    -------
+    dict
+        "mae", "rmse", "bias" and "count", the "targets" and "predictions" statistics,
+        and, when `cells` and `grid_shape` are given, "cell_mae" and "cell_rmse" maps of
+        shape grid_shape plus, with `months`, "month_mae" of shape (12, *grid_shape).
+        Cells without samples are NaN in the maps.
+    """
+    target_stats = StreamingStats()
+    prediction_stats = StreamingStats()
+    abs_error_sum = 0.0
+    squared_error_sum = 0.0
+    error_sum = 0.0
+    count = 0
+
+    with_maps = cells is not None and grid_shape is not None
+    if with_maps:
+        n_cells = grid_shape[0] * grid_shape[1]
+        cell_count = np.zeros(n_cells)
+        cell_abs_error = np.zeros(n_cells)
+        cell_squared_error = np.zeros(n_cells)
+        if months is not None:
+            month_count = np.zeros(12 * n_cells)
+            month_abs_error = np.zeros(12 * n_cells)
+
+    for start in range(0, len(targets), batch_size):
+        batch = np.asarray(sequences[start:start + batch_size])
+        if batch.ndim == 2:
+            batch = batch[..., np.newaxis]
+        batch_targets = np.asarray(targets[start:start + batch_size], dtype=np.float64)
+        predictions = np.asarray(model.predict_on_batch(batch), dtype=np.float64).reshape(-1)
+        errors = predictions - batch_targets
+
+        target_stats.update(batch_targets)
+        prediction_stats.update(predictions)
+        abs_error_sum += np.abs(errors).sum()
+        squared_error_sum += np.square(errors).sum()
+        error_sum += errors.sum()
+        count += errors.size
+
+        if with_maps:
+            batch_cells = np.asarray(cells[start:start + batch_size])
+            cell_count += np.bincount(batch_cells, minlength=n_cells)
+            cell_abs_error += np.bincount(batch_cells, weights=np.abs(errors), minlength=n_cells)
+            cell_squared_error += np.bincount(batch_cells, weights=np.square(errors), minlength=n_cells)
+            if months is not None:
+                keys = (np.asarray(months[start:start + batch_size], dtype=np.int64) - 1) * n_cells + batch_cells
+                month_count += np.bincount(keys, minlength=12 * n_cells)
+                month_abs_error += np.bincount(keys, weights=np.abs(errors), minlength=12 * n_cells)
+
+    results = {
+        "count": count,
+        "mae": abs_error_sum / count if count else np.nan,
+        "rmse": np.sqrt(squared_error_sum / count) if count else np.nan,
+        "bias": error_sum / count if count else np.nan,
+        "targets": target_stats.as_dict(),
+        "predictions": prediction_stats.as_dict(),
+    }
+
+    if with_maps:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            results["cell_mae"] = (cell_abs_error / cell_count).reshape(grid_shape)
+            results["cell_rmse"] = np.sqrt(cell_squared_error / cell_count).reshape(grid_shape)
+            if months is not None:
+                results["month_mae"] = (month_abs_error / month_count).reshape((12,) + tuple(grid_shape))
+
+    return results
@@ -0,0 +1,335 @@
+"""
+Trains one LSTM per (sequence length, units) configuration and ranks them by
+holdout MAE.
+
+The valid cells of every month are written once as a (cell, time) matrix in
+`.npy` files; worker processes memory-map them and take the windows of each
+sequence length as views of the same matrix, so no configuration rebuilds the
+sequence arrays from the cube. Configurations are trained concurrently in a
+process pool whose workers are pinned to a fixed number of threads. Cells are
+split three ways: early stopping watches the validation cells and the ranking
+uses holdout cells that training never saw.
+
+The matrices are stored under a fingerprint of the monthly arrays, missing
+indices and valid cells, and the results under a fingerprint of the matrices
+and the training settings, so changed inputs or settings never reuse stale
+outputs. Finished configurations are stored as JSON and skipped when the same
+sweep is rerun.
+
+Usage:
+    python hyperparameter_sweep.py --cube .pipeline_cache/ingest-<hash> \
+        --missing-indices missing_indices.json --sequence-length 3 --sequence-length 6 --units 25 --units 50
+"""
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from cube_layout import as_cell_time_matrix
+
+
+def sweep_fingerprint(monthly_data, missing_indices, valid_cells=None, chunk_size=1_000_000):
+    """
+    Hashes everything the sweep matrices are built from.
+
+    Parameters:
+    ----------
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    missing_indices : dict
+        A dictionary where keys are months (1-12) and values are the missing time index or indices.
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to keep.
+    chunk_size : int, optional
+        Number of cells hashed at a time, so memory-mapped arrays are never loaded whole.
+
+    Returns:
+    -------
+    str
+        A hex digest.
+    """
+    digest = hashlib.sha256()
+    for month in sorted(missing_indices):
+        digest.update(f"{month}:{np.atleast_1d(missing_indices[month]).tolist()}".encode())
+        matrix = as_cell_time_matrix(monthly_data[month])
+        digest.update(f"{matrix.dtype.str}{matrix.shape}".encode())
+        for start in range(0, len(matrix), chunk_size):
+            digest.update(np.ascontiguousarray(matrix[start:start + chunk_size]).tobytes())
+    if valid_cells is not None:
+        digest.update(np.ascontiguousarray(valid_cells, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def save_sweep_matrices(directory, monthly_data, missing_indices, valid_cells=None, dtype=np.float32):
+    """
+    Writes the (cell, time) matrix of every month in `missing_indices`, restricted to the valid cells.
+
+    Parameters:
+    ----------
+    directory : str
+        Destination directory; gets one `month_XX.npy` per month and `cells.npy`.
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    missing_indices : dict
+        A dictionary where keys are months (1-12) and values are the missing time index or indices.
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to keep. All cells are kept when omitted.
+    dtype : numpy dtype, optional
+        The dtype of the stored matrices (default float32).
+    """
+    # Write to a temporary directory first so an interrupted run never leaves partial matrices
+    temp_directory = f"{directory}.tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    for month in missing_indices:
+        matrix = as_cell_time_matrix(monthly_data[month])
+        if valid_cells is not None:
+            matrix = matrix[valid_cells]
+        np.save(os.path.join(temp_directory, f"month_{month:02d}.npy"), np.asarray(matrix, dtype=dtype))
+
+    n_cells = len(as_cell_time_matrix(next(iter(monthly_data.values()))))
+    cells = np.arange(n_cells, dtype=np.int64) if valid_cells is None else np.asarray(valid_cells, dtype=np.int64)
+    np.save(os.path.join(temp_directory, "cells.npy"), cells)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temp_directory, directory)
+
+
+def load_sweep_split(directory, missing_indices, sequence_length, validation_fraction=0.1, holdout_fraction=0.1,
+                     seed=42):
+    """
+    Builds the training, validation and holdout sets of one sequence length from the stored matrices.
+
+    The matrices are memory-mapped and windowed with zero-copy views; only the usable
+    windows of each split are gathered. Cells are assigned to the validation split by
+    the same hash as `prepare_train_test_data.iter_sequence_batches`; the next
+    `holdout_fraction` of the hash range forms the holdout split.
+
+    Returns:
+    -------
+    tuple
+        ((X_train, y_train), (X_val, y_val), (X_holdout, y_holdout)) with sequences of
+        shape (n_samples, sequence_length, 1).
+    """
+    from prepare_train_test_data import is_validation_cell, valid_windows
+
+    cells = np.load(os.path.join(directory, "cells.npy"))
+    splits = {subset: ([], []) for subset in ("train", "validation", "holdout")}
+    for month, missing_index in missing_indices.items():
+        matrix = np.load(os.path.join(directory, f"month_{month:02d}.npy"), mmap_mode="r")
+        if matrix.shape[1] <= sequence_length:
+            continue
+        windows, targets, valid = valid_windows(matrix, missing_index, sequence_length)
+        rows, steps = np.nonzero(valid)
+        in_validation = is_validation_cell(cells[rows], validation_fraction, seed)
+        in_holdout = is_validation_cell(cells[rows], validation_fraction + holdout_fraction, seed) & ~in_validation
+        for subset, keep in (("train", ~(in_validation | in_holdout)), ("validation", in_validation),
+                             ("holdout", in_holdout)):
+            splits[subset][0].append(windows[rows[keep], steps[keep]])
+            splits[subset][1].append(targets[rows[keep], steps[keep]])
+
+    def concatenate(sequences, targets):
+        if not sequences:
+            return np.empty((0, sequence_length, 1), dtype=np.float32), np.empty(0, dtype=np.float32)
+        return np.concatenate(sequences)[..., np.newaxis], np.concatenate(targets)
+
+    return tuple(concatenate(*splits[subset]) for subset in ("train", "validation", "holdout"))
+
+
+def _init_worker(threads):
+    """Pins the thread pools of a sweep worker before TensorFlow starts."""
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _configuration_name(sequence_length, units):
+    return f"seq{sequence_length:02d}_units{units:03d}"
+
+
+def _train_configuration(sequence_length, units, matrix_directory, missing_indices, output_directory, epochs,
+                         batch_size, validation_fraction, holdout_fraction, patience):
+    """
+    Trains one configuration in a worker process, scores it on the holdout cells and
+    stores its result as JSON.
+    """
+    from evaluation import evaluate_model
+    from training_harness import train_with_harness
+
+    name = _configuration_name(sequence_length, units)
+    configuration_directory = os.path.join(output_directory, name)
+    start = time.perf_counter()
+
+    (X_train, y_train), (X_val, y_val), (X_holdout, y_holdout) = load_sweep_split(
+        matrix_directory, missing_indices, sequence_length, validation_fraction, holdout_fraction
+    )
+    model, history = train_with_harness(
+        X_train, y_train, os.path.join(configuration_directory, "checkpoints"), epochs=epochs,
+        batch_size=batch_size, validation_data=(X_val, y_val), patience=patience, units=units
+    )
+    scores = evaluate_model(model, X_holdout, y_holdout)
+
+    result = {
+        "name": name,
+        "sequence_length": sequence_length,
+        "units": units,
+        "holdout_mae": float(scores["mae"]),
+        "holdout_rmse": float(scores["rmse"]),
+        "epochs_run": len(history.history.get("loss", [])),
+        "train_samples": int(len(y_train)),
+        "val_samples": int(len(y_val)),
+        "holdout_samples": int(len(y_holdout)),
+        "wall_seconds": round(time.perf_counter() - start, 2),
+    }
+    model.save(os.path.join(configuration_directory, "model.keras"))
+    with open(os.path.join(configuration_directory, "result.json"), "w") as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def write_leaderboard(output_directory, results):
+    """Ranks results by holdout MAE and writes `leaderboard.json` and `leaderboard.csv`."""
+    leaderboard = sorted(results, key=lambda result: result["holdout_mae"])
+    for rank, result in enumerate(leaderboard, start=1):
+        result["rank"] = rank
+
+    with open(os.path.join(output_directory, "leaderboard.json"), "w") as f:
+        json.dump(leaderboard, f, indent=2)
+
+    fields = ["rank", "name", "sequence_length", "units", "holdout_mae", "holdout_rmse", "epochs_run",
+              "train_samples", "val_samples", "holdout_samples", "wall_seconds"]
+    with open(os.path.join(output_directory, "leaderboard.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows({field: result[field] for field in fields} for result in leaderboard)
+    return leaderboard
+
+
+def run_sweep(monthly_data, missing_indices, output_directory, sequence_lengths=(3, 6, 9, 12), units=(25, 50, 100),
+              max_workers=None, threads_per_worker=1, epochs=20, batch_size=150, validation_fraction=0.1,
+              holdout_fraction=0.1, patience=3, valid_cells=None):
+    """
+    Trains every (sequence length, units) combination and writes a ranked leaderboard.
+
+    Parameters:
+    ----------
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    missing_indices : dict
+        A dictionary where keys are months (1-12) and values are the missing time index or indices.
+    output_directory : str
+        Directory for the shared matrices (`matrices-<fingerprint>`), the results
+        (`runs-<fingerprint>`, one sub-directory per configuration) and the leaderboard.
+    sequence_lengths : iterable of int, optional
+        Sequence lengths to try.
+    units : iterable of int, optional
+        LSTM widths to try.
+    max_workers : int, optional
+        Number of worker processes (default: CPUs // threads_per_worker).
+    threads_per_worker : int, optional
+        TensorFlow threads per worker.
+    epochs, batch_size, patience : int, optional
+        Training settings shared by every configuration (see `training_harness.train_with_harness`).
+    validation_fraction : float, optional
+        Fraction of grid cells held out for early stopping.
+    holdout_fraction : float, optional
+        Fraction of grid cells held out for scoring the configurations.
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to use. All cells are used when omitted.
+
+    Returns:
+    -------
+    list
+        The result of every configuration, best (lowest holdout MAE) first.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    matrix_fingerprint = sweep_fingerprint(monthly_data, missing_indices, valid_cells)
+    matrix_directory = os.path.join(output_directory, f"matrices-{matrix_fingerprint[:16]}")
+    if not os.path.exists(matrix_directory):
+        save_sweep_matrices(matrix_directory, monthly_data, missing_indices, valid_cells)
+    # Matrices of earlier inputs are never read again
+    for entry in os.listdir(output_directory):
+        if re.match(r"^matrices-[0-9a-f]{16}(\.tmp)?$", entry) and entry != os.path.basename(matrix_directory):
+            shutil.rmtree(os.path.join(output_directory, entry), ignore_errors=True)
+
+    settings = {"epochs": epochs, "batch_size": batch_size, "validation_fraction": validation_fraction,
+                "holdout_fraction": holdout_fraction, "patience": patience}
+    runs_fingerprint = hashlib.sha256(f"{matrix_fingerprint}:{json.dumps(settings, sort_keys=True)}".encode())
+    runs_directory = os.path.join(output_directory, f"runs-{runs_fingerprint.hexdigest()[:16]}")
+
+    results = []
+    pending = []
+    for sequence_length, width in itertools.product(sequence_lengths, units):
+        result_path = os.path.join(runs_directory, _configuration_name(sequence_length, width), "result.json")
+        if os.path.exists(result_path):
+            with open(result_path) as f:
+                results.append(json.load(f))
+        else:
+            pending.append((sequence_length, width))
+    print(f"Configurations: {len(results) + len(pending)} total, {len(results)} already done.")
+
+    if pending:
+        max_workers = max_workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(threads_per_worker,)) as executor:
+            futures = [
+                executor.submit(
+                    _train_configuration, sequence_length, width, matrix_directory, missing_indices,
+                    runs_directory, epochs, batch_size, validation_fraction, holdout_fraction, patience
+                )
+                for sequence_length, width in pending
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(f"{result['name']}: holdout MAE {result['holdout_mae']:.4f} in {result['wall_seconds']:.1f} s")
+
+    leaderboard = write_leaderboard(output_directory, results)
+    print(f"Best configuration: {leaderboard[0]['name']} (holdout MAE {leaderboard[0]['holdout_mae']:.4f})")
+    return leaderboard
+
+
+def main():
+    from monthly_array_cache import open_monthly_arrays, open_valid_cell_index
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cube", required=True, help="Monthly array cache directory (see monthly_array_cache).")
+    parser.add_argument("--missing-indices", required=True, help="JSON file of {month: index or [indices]}.")
+    parser.add_argument("--output", default="sweep", help="Output directory.")
+    parser.add_argument("--sequence-length", type=int, action="append", help="Repeatable (default 3, 6, 9, 12).")
+    parser.add_argument("--units", type=int, action="append", help="Repeatable (default 25, 50, 100).")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=150)
+    parser.add_argument("--patience", type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.missing_indices) as f:
+        missing_indices = {int(month): index for month, index in json.load(f).items()}
+
+    run_sweep(
+        open_monthly_arrays(args.cube), missing_indices, args.output,
+        sequence_lengths=args.sequence_length or (3, 6, 9, 12), units=args.units or (25, 50, 100),
+        max_workers=args.workers, threads_per_worker=args.threads_per_worker, epochs=args.epochs,
+        batch_size=args.batch_size, patience=args.patience, valid_cells=open_valid_cell_index(args.cube)
+    )
+
+
+if __name__ == "__main__":
+    main()
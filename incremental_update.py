@@ -0,0 +1,552 @@
+"""
+Incremental refresh of the gap-filled record when new monthly TIFFs are published.
+
+A state directory holds everything a refresh needs from the previous run:
+
+    cube/                  monthly arrays (monthly_array_cache layout)
+    sequences/part_*/      training windows as .npy files, one part per refresh
+                           (named after the refresh, so a rerun does not add it twice)
+    model.keras            trained model, plus lstm_weights.npz for inference
+    interpolated.npz       predictions for every gap (sparse overlay)
+    state.json             years, sequence length, ingested files, progress of an
+                           unfinished refresh
+
+`update_with_new_months` reads only the TIFFs that are not in the state yet,
+writes them into the persisted cube, builds only the windows that the new months
+made valid, optionally fine-tunes the model for a few epochs, and re-predicts only
+the gaps whose input window contains a new month (every gap when the model
+changed). A refresh that crashed part-way can be rerun: its sequence part is
+not added again and a model it already fine-tuned is not fine-tuned twice.
+
+Usage:
+    python incremental_update.py init --state state --tiff-directory TIFFs --shapefile India.shp \
+        --start-year 2003 --end-year 2021 --sequence-length 6 --model model.keras
+    python incremental_update.py update --state state --training fine_tune --epochs 3
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from calculate_missing_indices_of_monthly_arrays import (
+    build_availability_matrix,
+    mark_unpublished_months_available,
+    missing_indices_from_availability,
+)
+from cube_layout import as_cell_time_matrix, build_valid_cell_index, save_valid_cell_index
+from interpolation_using_trained_model import load_overlay, predict_missing_values, save_overlay
+from monthly_array_cache import open_monthly_arrays, open_valid_cell_index, save_monthly_arrays
+from prepare_train_test_data import valid_windows
+
+FILENAME_PATTERN = re.compile(r"TWSA_(\d{4})(\d{2})_")
+
+
+def _is_tiff_name(file):
+    """True for monthly TWSA GeoTIFFs; sidecars such as `.tif.aux.xml` also match the pattern."""
+    return file.endswith(".tif") and FILENAME_PATTERN.search(file) is not None
+
+
+def _read_state(state_directory):
+    with open(os.path.join(state_directory, "state.json")) as f:
+        return json.load(f)
+
+
+def _write_state(state_directory, state):
+    temp_path = os.path.join(state_directory, "state.json.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(temp_path, os.path.join(state_directory, "state.json"))
+
+
+def detect_gaps(monthly_data, tiff_files, start_year, end_year):
+    """
+    Finds the missing (month, year index) pairs of the record.
+
+    Months after the latest available month are not published yet rather than
+    missing, so they are not reported as gaps.
+
+    Returns:
+    -------
+    dict
+        A dictionary where keys are months (1-12) and values are int64 arrays of missing indices.
+    """
+    availability = build_availability_matrix(tiff_files, start_year, end_year, monthly_data)
+    gaps = missing_indices_from_availability(mark_unpublished_months_available(availability))
+    return {month: np.asarray(gaps.get(month, []), dtype=np.int64) for month in range(1, 13)}
+
+
+def build_new_windows(monthly_data, gaps, changed, sequence_length, valid_cells):
+    """
+    Builds the training windows that involve at least one changed (month, year index).
+
+    A window with target index t reads indices t - sequence_length .. t - 1, so a
+    change at index c affects the targets c .. c + sequence_length. Windows over
+    indices that were NaN before could not have been valid, so these windows are
+    exactly the ones missing from the stored sequence set.
+
+    Parameters:
+    ----------
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    gaps : dict
+        Missing indices of every month (see `detect_gaps`); their targets are excluded.
+    changed : dict
+        A dictionary where keys are months and values are the newly filled time indices.
+    sequence_length : int
+        The length of each input sequence.
+    valid_cells : np.ndarray
+        Flat indices of the cells to use.
+
+    Returns:
+    -------
+    dict
+        "sequences" (n, sequence_length), "targets", "cells" and "months" arrays of the new windows.
+    """
+    parts = {"sequences": [], "targets": [], "cells": [], "months": []}
+    for month, indices in changed.items():
+        matrix = np.asarray(as_cell_time_matrix(monthly_data[month])[valid_cells])
+        if matrix.shape[1] <= sequence_length:
+            continue
+        windows, targets, valid = valid_windows(matrix, gaps[month], sequence_length)
+
+        affected = np.zeros(matrix.shape[1], dtype=bool)
+        for index in indices:
+            affected[index:index + sequence_length + 1] = True
+        valid &= affected[sequence_length:]
+
+        rows, steps = np.nonzero(valid)
+        parts["sequences"].append(windows[rows, steps])
+        parts["targets"].append(targets[rows, steps])
+        parts["cells"].append(valid_cells[rows])
+        parts["months"].append(np.full(len(rows), month, dtype=np.int8))
+
+    if not parts["targets"]:
+        dtype = next(iter(monthly_data.values())).dtype
+        return {
+            "sequences": np.empty((0, sequence_length), dtype=dtype), "targets": np.empty(0, dtype=dtype),
+            "cells": np.empty(0, dtype=np.int64), "months": np.empty(0, dtype=np.int8),
+        }
+    return {name: np.concatenate(arrays) for name, arrays in parts.items()}
+
+
+_SEQUENCE_ARRAYS = ("sequences", "targets", "cells", "months")
+_PART_NAME = re.compile(r"^part_\d{4}_[0-9a-f]{16}$")
+
+
+def _refresh_id(files):
+    """Identifies a refresh by the files it ingests."""
+    return hashlib.sha256("\n".join(sorted(files)).encode()).hexdigest()[:16]
+
+
+def _save_sequence_part(state_directory, part, refresh_id):
+    """Stores the windows of one refresh, unless a part for `refresh_id` already exists."""
+    directory = os.path.join(state_directory, "sequences")
+    os.makedirs(directory, exist_ok=True)
+    parts = [f for f in os.listdir(directory) if _PART_NAME.match(f)]
+    if any(f.endswith(f"_{refresh_id}") for f in parts):
+        print(f"Sequence part of refresh {refresh_id} already stored.")
+        return
+    part_directory = os.path.join(directory, f"part_{len(parts):04d}_{refresh_id}")
+    temp_directory = f"{part_directory}.tmp"
+    os.makedirs(temp_directory, exist_ok=True)
+    for name in _SEQUENCE_ARRAYS:
+        np.save(os.path.join(temp_directory, f"{name}.npy"), part[name])
+    os.replace(temp_directory, part_directory)
+
+
+def open_sequence_parts(state_directory):
+    """Memory-maps every stored sequence part, oldest first, as dicts of arrays."""
+    directory = os.path.join(state_directory, "sequences")
+    return [
+        {name: np.load(os.path.join(directory, part, f"{name}.npy"), mmap_mode="r") for name in _SEQUENCE_ARRAYS}
+        for part in sorted(f for f in os.listdir(directory) if _PART_NAME.match(f))
+    ]
+
+
+def load_sequences(state_directory, rows=None):
+    """
+    Reads stored windows into memory as (sequences, targets, cells, months).
+
+    Parameters:
+    ----------
+    state_directory : str
+        Directory created by `initialize_update_state`.
+    rows : np.ndarray, optional
+        Row numbers across all parts (oldest first) to read, in the order wanted.
+        Only these rows are read from the memory-mapped parts; every row is read
+        when omitted.
+    """
+    parts = open_sequence_parts(state_directory)
+    if rows is None:
+        return tuple(np.concatenate([part[name] for part in parts]) for name in _SEQUENCE_ARRAYS)
+
+    rows = np.asarray(rows, dtype=np.int64)
+    offsets = np.cumsum([0] + [len(part["targets"]) for part in parts])
+    selected = [np.empty((len(rows),) + parts[0][name].shape[1:], dtype=parts[0][name].dtype)
+                for name in _SEQUENCE_ARRAYS]
+    owner = np.searchsorted(offsets, rows, side="right") - 1
+    for number, part in enumerate(parts):
+        positions = np.flatnonzero(owner == number)
+        local_rows = rows[positions] - offsets[number]
+        # Read the memory map in ascending row order, then put the rows where they were asked for
+        order = np.argsort(local_rows, kind="stable")
+        for array, name in zip(selected, _SEQUENCE_ARRAYS):
+            array[positions[order]] = part[name][local_rows[order]]
+    return tuple(selected)
+
+
+def _gaps_to_reinfer(gaps, previous_gaps, changed, sequence_length):
+    """
+    Selects the gaps that are new or whose input window contains a changed index.
+
+    Gaps are visited in time order and a selected gap counts as changed for the
+    later gaps of its month, since their windows read its prediction.
+    """
+    selected = {}
+    for month, indices in gaps.items():
+        previous = set(previous_gaps.get(str(month), []))
+        month_changed = list(changed.get(month, []))
+        chosen = []
+        for index in sorted(int(index) for index in indices):
+            if index not in previous or any(index - sequence_length <= c < index for c in month_changed):
+                chosen.append(index)
+                month_changed.append(index)
+        if chosen:
+            selected[month] = chosen
+    return selected
+
+
+def _merge_overlay(overlay, update, gaps):
+    """Replaces the predictions of the updated gaps and drops those of gaps that were filled."""
+    merged = {}
+    for month in set(overlay) | set(update):
+        parts = []
+        if month in overlay:
+            time_indices, cells, values = overlay[month]
+            replaced = update[month][0] if month in update else []
+            keep = np.isin(time_indices, gaps[month]) & ~np.isin(time_indices, replaced)
+            parts.append((time_indices[keep], cells[keep], values[keep]))
+        if month in update:
+            parts.append(update[month])
+        time_indices, cells, values = (np.concatenate(arrays) for arrays in zip(*parts))
+        if len(time_indices):
+            merged[month] = (time_indices, cells, values)
+    return merged
+
+
+def _export_model(model, state_directory):
+    from numpy_lstm import export_lstm_weights
+
+    model.save(os.path.join(state_directory, "model.keras"))
+    export_lstm_weights(model, os.path.join(state_directory, "lstm_weights.npz"))
+
+
+def initialize_update_state(state_directory, monthly_data, tiff_directory, shapefile, start_year, end_year,
+                            sequence_length, model, inference_batch_size=65536):
+    """
+    Creates the state directory from a full run.
+
+    Parameters:
+    ----------
+    state_directory : str
+        Directory to create.
+    monthly_data : dict
+        Monthly 3D arrays from `create_monthly_3d_arrays_with_mask`.
+    tiff_directory, shapefile : str
+        Where later refreshes look for TIFFs and the mask.
+    start_year, end_year : int
+        Year range of `monthly_data`.
+    sequence_length : int
+        The length of each input sequence.
+    model : tf.keras.Model
+        The trained model.
+    inference_batch_size : int, optional
+        Number of cells sent to the model per call.
+    """
+    from tiled_interpolation import load_inference_model
+
+    os.makedirs(state_directory, exist_ok=True)
+    cube_directory = os.path.join(state_directory, "cube")
+    save_monthly_arrays(cube_directory, monthly_data, {"start_year": start_year, "end_year": end_year})
+    cube = open_monthly_arrays(cube_directory)
+    valid_cells = open_valid_cell_index(cube_directory)
+
+    tiff_files = sorted(f for f in os.listdir(tiff_directory) if _is_tiff_name(f))
+    gaps = detect_gaps(cube, tiff_files, start_year, end_year)
+
+    # Every available index counts as changed, which yields the full sequence set
+    available = {month: np.arange(cube[month].shape[2]) for month in cube}
+    _save_sequence_part(
+        state_directory, build_new_windows(cube, gaps, available, sequence_length, valid_cells),
+        _refresh_id(tiff_files)
+    )
+
+    _export_model(model, state_directory)
+    inference_model = load_inference_model(os.path.join(state_directory, "lstm_weights.npz"))
+    overlay = predict_missing_values(
+        inference_model, cube, {month: indices for month, indices in gaps.items() if len(indices)},
+        sequence_length, inference_batch_size, valid_cells
+    )
+    save_overlay(os.path.join(state_directory, "interpolated.npz"), overlay)
+
+    _write_state(state_directory, {
+        "start_year": start_year,
+        "end_year": end_year,
+        "sequence_length": sequence_length,
+        "tiff_directory": tiff_directory,
+        "shapefile": shapefile,
+        "ingested_files": tiff_files,
+        "gaps": {str(month): indices.tolist() for month, indices in gaps.items()},
+    })
+    print(f"Initialized update state: {state_directory}")
+
+
+def _extend_cube(cube_directory, new_end_year):
+    """Adds NaN years to every monthly array of the cube so it reaches `new_end_year`."""
+    with open(os.path.join(cube_directory, "metadata.json")) as f:
+        metadata = json.load(f)
+    if metadata["end_year"] >= new_end_year:
+        # Already extended by a refresh that did not finish
+        return
+
+    total_years = new_end_year - metadata["start_year"] + 1
+    for month in metadata["months"]:
+        path = os.path.join(cube_directory, f"month_{month:02d}.npy")
+        old = np.load(path, mmap_mode="r")
+        temp_path = f"{path[:-4]}.tmp.npy"
+        extended = np.lib.format.open_memmap(temp_path, mode="w+", dtype=old.dtype,
+                                             shape=old.shape[:2] + (total_years,))
+        extended[..., :old.shape[2]] = old
+        extended[..., old.shape[2]:] = np.nan
+        extended.flush()
+        del old, extended
+        os.replace(temp_path, path)
+
+    metadata["end_year"] = new_end_year
+    with open(os.path.join(cube_directory, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def update_with_new_months(state_directory, training="fine_tune", fine_tune_epochs=3, batch_size=150,
+                           replay_ratio=1.0, inference_batch_size=65536, seed=0):
+    """
+    Brings the state up to date with the TIFFs published since the last run.
+
+    Files already in the state are not read again; a republished file with a name
+    that was already ingested is ignored.
+
+    Parameters:
+    ----------
+    state_directory : str
+        Directory created by `initialize_update_state`.
+    training : str, optional
+        "fine_tune" trains the stored model for `fine_tune_epochs` more epochs on the
+        new windows plus a random replay sample of the stored ones; "skip" keeps it.
+    fine_tune_epochs : int, optional
+        Number of fine-tuning epochs.
+    batch_size : int, optional
+        Samples per fine-tuning batch.
+    replay_ratio : float, optional
+        Stored windows replayed per new window while fine-tuning, so the model does
+        not drift towards the newest months only.
+    inference_batch_size : int, optional
+        Number of cells sent to the model per call.
+    seed : int, optional
+        Seed for the replay sample.
+
+    Returns:
+    -------
+    dict
+        Summary of the refresh: new files, new windows, re-predicted cells and seconds.
+    """
+    import geopandas as gpd
+
+    from create_monthly_arrays import prepare_mask_window, read_masked_window
+    from tiled_interpolation import load_inference_model
+
+    if training not in ("fine_tune", "skip"):
+        raise ValueError(f"Unknown training mode '{training}', expected 'fine_tune' or 'skip'.")
+
+    start = time.perf_counter()
+    state = _read_state(state_directory)
+    cube_directory = os.path.join(state_directory, "cube")
+    sequence_length = state["sequence_length"]
+    start_year = state["start_year"]
+
+    ingested = set(state["ingested_files"])
+    new_files = sorted(
+        f for f in os.listdir(state["tiff_directory"]) if _is_tiff_name(f) and f not in ingested
+    )
+    if not new_files:
+        print("No new months to ingest.")
+        return {
+            "new_files": [], "new_windows": 0, "model_updated": False, "reinferred_gaps": {},
+            "reinferred_cells": 0, "seconds": round(time.perf_counter() - start, 2),
+        }
+    refresh_id = _refresh_id(new_files)
+    resumed = state.get("refresh", {}).get("id") == refresh_id
+
+    # 1. Append the new months to the persisted cube
+    dates = [tuple(map(int, FILENAME_PATTERN.search(f).groups())) for f in new_files]
+    end_year = max(state["end_year"], max(year for year, _ in dates))
+    if end_year > state["end_year"]:
+        _extend_cube(cube_directory, end_year)
+
+    cube = open_monthly_arrays(cube_directory, mmap_mode="r+")
+    grid_shape = next(iter(cube.values())).shape[:2]
+    window, outside_mask, nodata = prepare_mask_window(
+        new_files, state["tiff_directory"], gpd.read_file(state["shapefile"])
+    )
+    if outside_mask.shape != grid_shape:
+        raise ValueError(f"New TIFFs cover a {outside_mask.shape} grid, but the cube is {grid_shape}.")
+
+    changed = {}
+    for file, (year, month) in zip(new_files, dates):
+        if year < start_year:
+            continue
+        cube[month][:, :, year - start_year] = read_masked_window(
+            os.path.join(state["tiff_directory"], file), window, outside_mask, nodata, cube[month].dtype
+        )
+        changed.setdefault(month, []).append(year - start_year)
+    for array in cube.values():
+        array.flush()
+
+    valid_cells = build_valid_cell_index(cube)
+    save_valid_cell_index(os.path.join(cube_directory, "valid_cells.npz"), valid_cells, grid_shape)
+    print(f"Ingested {len(new_files)} new files: {', '.join(new_files)}")
+
+    # 2. Extend the sequence set with the windows the new months made valid
+    tiff_files = sorted(ingested | set(new_files))
+    gaps = detect_gaps(cube, tiff_files, start_year, end_year)
+    new_windows = build_new_windows(cube, gaps, changed, sequence_length, valid_cells)
+    _save_sequence_part(state_directory, new_windows, refresh_id)
+    print(f"New training windows: {len(new_windows['targets'])}")
+
+    # 3. Fine-tune the stored model, or keep it
+    already_fine_tuned = resumed and state["refresh"]["fine_tuned"]
+    model_changed = already_fine_tuned or (training == "fine_tune" and len(new_windows["targets"]) > 0)
+    if already_fine_tuned:
+        print(f"Model already fine-tuned by refresh {refresh_id}.")
+    elif model_changed:
+        import tensorflow as tf
+
+        # Only the replayed and new rows are read from the stored parts
+        n_total = sum(len(part["targets"]) for part in open_sequence_parts(state_directory))
+        n_new = len(new_windows["targets"])
+        n_old = n_total - n_new
+        rng = np.random.default_rng(seed)
+        replay = rng.choice(n_old, size=min(n_old, int(replay_ratio * n_new)), replace=False)
+        # Shuffled so the validation split (the last rows) mixes replayed and new windows
+        rows = rng.permutation(np.concatenate([replay, np.arange(n_old, n_total)]))
+        sequences, targets, _, _ = load_sequences(state_directory, rows)
+
+        model = tf.keras.models.load_model(os.path.join(state_directory, "model.keras"))
+        model.fit(sequences[..., np.newaxis], targets, epochs=fine_tune_epochs, batch_size=batch_size,
+                  validation_split=0.1)
+        _export_model(model, state_directory)
+        # Recorded before anything else can fail, so a rerun does not fine-tune again
+        _write_state(state_directory, {**state, "refresh": {"id": refresh_id, "fine_tuned": True}})
+
+    # 4. Re-predict the gaps whose inputs changed (all gaps if the model changed)
+    if model_changed:
+        to_infer = {month: indices.tolist() for month, indices in gaps.items() if len(indices)}
+    else:
+        to_infer = _gaps_to_reinfer(gaps, state["gaps"], changed, sequence_length)
+
+    # Gaps that are not re-predicted still feed the windows of the later ones
+    inference_model = load_inference_model(os.path.join(state_directory, "lstm_weights.npz"))
+    overlay_path = os.path.join(state_directory, "interpolated.npz")
+    overlay = load_overlay(overlay_path)
+    update = predict_missing_values(
+        inference_model, cube, to_infer, sequence_length, inference_batch_size, valid_cells, prior_overlay=overlay
+    ) if to_infer else {}
+    save_overlay(overlay_path, _merge_overlay(overlay, update, gaps))
+
+    state.update({
+        "end_year": end_year,
+        "ingested_files": tiff_files,
+        "gaps": {str(month): indices.tolist() for month, indices in gaps.items()},
+    })
+    state.pop("refresh", None)
+    _write_state(state_directory, state)
+
+    summary = {
+        "new_files": new_files,
+        "new_windows": int(len(new_windows["targets"])),
+        "model_updated": model_changed,
+        "reinferred_gaps": {str(month): indices for month, indices in to_infer.items()},
+        "reinferred_cells": int(sum(len(values) for _, _, values in update.values())),
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+    print(f"Refresh finished in {summary['seconds']:.1f} s; re-predicted {summary['reinferred_cells']} cells.")
+    return summary
+
+
+def load_interpolated_monthly_arrays(state_directory):
+    """
+    Returns the gap-filled monthly arrays of the state.
+
+    Returns:
+    -------
+    tuple
+        A dict of month -> 3D array with the predictions written into the gaps, and the
+        missing indices as {month: [indices]} for the months that have gaps.
+    """
+    from interpolation_using_trained_model import apply_overlay
+
+    state = _read_state(state_directory)
+    monthly_data = {
+        month: np.array(array) for month, array in open_monthly_arrays(os.path.join(state_directory, "cube")).items()
+    }
+    apply_overlay(monthly_data, load_overlay(os.path.join(state_directory, "interpolated.npz")))
+    missing_indices = {int(month): indices for month, indices in state["gaps"].items() if indices}
+    return monthly_data, missing_indices
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="Create the state from a full ingestion and a trained model.")
+    init_parser.add_argument("--state", required=True)
+    init_parser.add_argument("--tiff-directory", required=True)
+    init_parser.add_argument("--shapefile", required=True)
+    init_parser.add_argument("--start-year", type=int, required=True)
+    init_parser.add_argument("--end-year", type=int, required=True)
+    init_parser.add_argument("--sequence-length", type=int, default=6)
+    init_parser.add_argument("--model", required=True, help="Model saved with model.save (.keras).")
+
+    update_parser = subparsers.add_parser("update", help="Ingest newly published months.")
+    update_parser.add_argument("--state", required=True)
+    update_parser.add_argument("--training", choices=["fine_tune", "skip"], default="fine_tune")
+    update_parser.add_argument("--epochs", type=int, default=3)
+    update_parser.add_argument("--batch-size", type=int, default=150)
+    args = parser.parse_args()
+
+    if args.command == "init":
+        import geopandas as gpd
+        import tensorflow as tf
+
+        from create_monthly_arrays import create_monthly_3d_arrays_with_mask
+
+        tiff_files = sorted(f for f in os.listdir(args.tiff_directory) if _is_tiff_name(f))
+        monthly_data = create_monthly_3d_arrays_with_mask(
+            tiff_files, [], args.start_year, args.end_year, args.tiff_directory, gpd.read_file(args.shapefile)
+        )
+        initialize_update_state(
+            args.state, monthly_data, args.tiff_directory, args.shapefile, args.start_year, args.end_year,
+            args.sequence_length, tf.keras.models.load_model(args.model)
+        )
+    else:
+        summary = update_with_new_months(
+            args.state, training=args.training, fine_tune_epochs=args.epochs, batch_size=args.batch_size
+        )
+        print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+import numpy as np
+
+from cube_layout import as_cell_time_matrix
+
+
 def interpolate_missing_data_with_lstm(model, monthly_data, missing_indices, sequence_length):
     """
     Interpolates missing data in monthly time series using an LSTM model.
@@ -51,5 +56,252 @@ def interpolate_missing_data_with_lstm(model, monthly_data, missing_indices, seq
     
     return interpolated_data
 
-# Perform interpolation using the LSTM model
-interpolated_monthly_india_data = interpolate_missing_data_with_lstm(model, monthly_india_3d_arrays, missing_indices, sequence_length)
+
+def gather_missing_windows(monthly_data, missing_indices, sequence_length, valid_cells=None, overlay=None):
+    """
+    Collects the LSTM input window of every NaN cell at every missing index.
+
+    A month may have one missing index or a list of them; every (month, index)
+    pair contributes its NaN cells to the same batch.
+
+    The windows are built exactly like the per-cell path: NaNs inside a window
+    become -9999.0, and windows that would start before the first year are
+    left-padded with zeros. They are gathered from the (cell, time) layout of
+    each monthly array and keep its dtype. Values already predicted for earlier
+    gaps can be passed as `overlay`; they are read in place of the NaNs they fill.
+
+    Parameters:
+    monthly_data (dict): Dictionary with months as keys and corresponding 3D numpy arrays as values.
+    missing_indices (dict): Dictionary with months as keys and the missing index (year), or a
+        list of missing indices, as values.
+    sequence_length (int): Length of the input sequences for LSTM.
+    valid_cells (np.ndarray, optional): Flat indices of the cells to fill. All cells are
+        considered when omitted, which also fills cells that are NaN in every year.
+    overlay (dict, optional): Sparse overlay of earlier predictions (see `predict_missing_values`).
+
+    Returns:
+    tuple: (windows, locations) where windows has shape (n_cells, sequence_length, 1)
+        and locations is a list of (month, missing_index, cells) entries, in the same
+        order as the windows, where cells are flat (cell, time) row indices.
+    """
+    windows = []
+    locations = []
+
+    for month, month_indices in missing_indices.items():
+        matrix = as_cell_time_matrix(monthly_data[month])
+        for missing_index in np.atleast_1d(month_indices).tolist():
+            if valid_cells is None:
+                cells = np.flatnonzero(np.isnan(matrix[:, missing_index]))
+            else:
+                cells = valid_cells[np.isnan(matrix[valid_cells, missing_index])]
+            if cells.size == 0:
+                continue
+
+            start = max(missing_index - sequence_length, 0)
+            month_windows = matrix[cells, start:missing_index]
+            if overlay is not None and month in overlay:
+                _fill_from_overlay(month_windows, cells, start, overlay[month])
+            month_windows = np.nan_to_num(month_windows, nan=-9999.0)
+            if missing_index < sequence_length:
+                # Left-pad short histories with zeros, as in the per-cell path
+                month_windows = np.pad(
+                    month_windows, ((0, 0), (sequence_length - missing_index, 0)),
+                    'constant', constant_values=0
+                )
+
+            windows.append(month_windows)
+            locations.append((month, missing_index, cells))
+
+    if not windows:
+        dtype = next(iter(monthly_data.values())).dtype if monthly_data else np.float32
+        return np.empty((0, sequence_length, 1), dtype=dtype), locations
+
+    return np.concatenate(windows, axis=0)[..., np.newaxis], locations
+
+
+def _fill_from_overlay(windows, cells, start, month_overlay):
+    """Writes the overlay values that fall on NaNs of the windows (rows `cells`, columns from `start`)."""
+    time_indices, overlay_cells, values = month_overlay
+    inside = (time_indices >= start) & (time_indices < start + windows.shape[1])
+    if not inside.any():
+        return
+
+    time_indices, overlay_cells, values = time_indices[inside], overlay_cells[inside], values[inside]
+    order = np.argsort(cells, kind="stable")
+    rows = order[np.minimum(np.searchsorted(cells, overlay_cells, sorter=order), cells.size - 1)]
+    columns = time_indices - start
+    found = cells[rows] == overlay_cells
+    found[found] = np.isnan(windows[rows[found], columns[found]])
+    windows[rows[found], columns[found]] = values[found]
+
+
+def predict_in_batches(model, inputs, batch_size=65536):
+    """
+    Runs the model over `inputs` in large fixed-size chunks.
+
+    Parameters:
+    model (tf.keras.Model): Trained LSTM model for interpolation.
+    inputs (np.ndarray): Model inputs of shape (n_samples, sequence_length, 1).
+    batch_size (int): Number of samples sent to the model per call.
+
+    Returns:
+    np.ndarray: Flat array of predictions, one per input sample.
+    """
+    predictions = np.empty(len(inputs), dtype=inputs.dtype)
+    for start in range(0, len(inputs), batch_size):
+        batch = inputs[start:start + batch_size]
+        predictions[start:start + len(batch)] = np.asarray(model.predict_on_batch(batch)).reshape(-1)
+    return predictions
+
+
+def predict_missing_values(model, monthly_data, missing_indices, sequence_length, batch_size=65536,
+                           valid_cells=None, prior_overlay=None):
+    """
+    Predicts every missing cell without touching the monthly arrays.
+
+    Gaps are filled in increasing time order: the first missing index of every
+    month is predicted in one batch, then the second, and so on, and each round
+    reads the predictions of the earlier rounds. When the same month is missing
+    in consecutive years, the later window therefore holds the earlier fill
+    rather than the -9999.0 placeholder, as if the arrays were filled one gap
+    at a time.
+
+    Parameters:
+    model (tf.keras.Model): Trained LSTM model for interpolation.
+    monthly_data (dict): Dictionary with months as keys and corresponding 3D numpy arrays as values.
+    missing_indices (dict): Dictionary with months as keys and the missing index (year), or a
+        list of missing indices, as values.
+    sequence_length (int): Length of the input sequences for LSTM.
+    batch_size (int): Number of cells sent to the model per call.
+    valid_cells (np.ndarray, optional): Flat indices of the cells to fill.
+    prior_overlay (dict, optional): Predictions of gaps filled by an earlier run, read by
+        the windows of later gaps. Entries at the indices being predicted are ignored.
+
+    Returns:
+    dict: Sparse overlay with months as keys and (time_indices, cells, values) as values,
+        three arrays of equal length where cells are flat (cell, time) row indices.
+        Only the predictions of `missing_indices` are included.
+    """
+    month_indices = {
+        month: sorted(set(np.atleast_1d(indices).tolist())) for month, indices in missing_indices.items()
+    }
+
+    known = {}
+    for month, (time_indices, cells, values) in (prior_overlay or {}).items():
+        keep = ~np.isin(time_indices, month_indices.get(month, []))
+        known[month] = [(time_indices[keep], cells[keep], values[keep])]
+
+    parts = {}
+    n_predicted = 0
+    for wave in range(max((len(indices) for indices in month_indices.values()), default=0)):
+        wave_indices = {month: indices[wave] for month, indices in month_indices.items() if wave < len(indices)}
+        overlay = {
+            month: tuple(np.concatenate(arrays) for arrays in zip(*month_parts))
+            for month, month_parts in known.items()
+        }
+        windows, locations = gather_missing_windows(
+            monthly_data, wave_indices, sequence_length, valid_cells, overlay
+        )
+        predictions = predict_in_batches(model, windows, batch_size)
+        n_predicted += len(predictions)
+
+        offset = 0
+        for month, missing_index, cells in locations:
+            time_indices = np.full(cells.size, missing_index, dtype=np.int64)
+            part = (time_indices, cells, predictions[offset:offset + cells.size])
+            parts.setdefault(month, []).append(part)
+            known.setdefault(month, []).append(part)
+            offset += cells.size
+    print(f"Predicted {n_predicted} missing cells across {len(missing_indices)} months.")
+
+    return {
+        month: tuple(np.concatenate(arrays) for arrays in zip(*month_parts))
+        for month, month_parts in parts.items()
+    }
+
+
+def apply_overlay(monthly_data, overlay):
+    """
+    Writes the values of a sparse overlay into the monthly arrays in place.
+
+    Values are scattered through the 3D arrays, so any memory layout works.
+
+    Parameters:
+    monthly_data (dict): Dictionary with months as keys and corresponding writable 3D numpy arrays as values.
+    overlay (dict): Overlay returned by `predict_missing_values`.
+    """
+    for month, (time_indices, cells, values) in overlay.items():
+        array = monthly_data[month]
+        rows, cols = np.unravel_index(cells, array.shape[:2])
+        array[rows, cols, time_indices] = values
+
+
+def save_overlay(path, overlay):
+    """
+    Saves a sparse overlay to an .npz file.
+
+    Parameters:
+    path (str): Destination of the .npz file.
+    overlay (dict): Overlay returned by `predict_missing_values`.
+    """
+    arrays = {"months": np.array(sorted(overlay), dtype=np.int64)}
+    for month, (time_indices, cells, values) in overlay.items():
+        arrays[f"missing_{month}"] = time_indices
+        arrays[f"cells_{month}"] = cells
+        arrays[f"values_{month}"] = values
+    np.savez(path, **arrays)
+
+
+def load_overlay(path):
+    """
+    Reads an overlay written by `save_overlay`.
+
+    Returns:
+    dict: Overlay with months as keys and (time_indices, cells, values) as values.
+    """
+    with np.load(path) as arrays:
+        return {
+            int(month): (arrays[f"missing_{month}"], arrays[f"cells_{month}"], arrays[f"values_{month}"])
+            for month in arrays["months"]
+        }
+
+
+def interpolate_missing_data_with_lstm_batched(model, monthly_data, missing_indices, sequence_length,
+                                               batch_size=65536, in_place=False, valid_cells=None):
+    """
+    Batched equivalent of `interpolate_missing_data_with_lstm`.
+
+    All NaN cells of all missing months are gathered into one input array per
+    round of gaps (see `predict_missing_values`), predicted in chunks of
+    `batch_size` and scattered back, so the model is called a handful of times
+    instead of once per grid cell.
+
+    Parameters:
+    model (tf.keras.Model): Trained LSTM model for interpolation.
+    monthly_data (dict): Dictionary with months as keys and corresponding 3D numpy arrays as values.
+    missing_indices (dict): Dictionary with months as keys and the missing index (year), or a
+        list of missing indices, as values.
+    sequence_length (int): Length of the input sequences for LSTM.
+    batch_size (int): Number of cells sent to the model per call.
+    in_place (bool): Write the predictions into `monthly_data` instead of copying each
+        missing month's array first.
+    valid_cells (np.ndarray, optional): Flat indices of the cells to fill; cells outside
+        the index (ocean or outside the mask) are left as NaN.
+
+    Returns:
+    dict: Dictionary containing interpolated data for each month.
+    """
+    overlay = predict_missing_values(model, monthly_data, missing_indices, sequence_length, batch_size, valid_cells)
+
+    if in_place:
+        interpolated_data = {month: monthly_data[month] for month in missing_indices}
+    else:
+        interpolated_data = {month: np.copy(monthly_data[month], order="C") for month in missing_indices}
+    apply_overlay(interpolated_data, overlay)
+
+    return interpolated_data
+
+
+if __name__ == "__main__":
+    # Perform interpolation using the LSTM model
+    interpolated_monthly_india_data = interpolate_missing_data_with_lstm_batched(model, monthly_india_3d_arrays, missing_indices, sequence_length)
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from cube_layout import build_valid_cell_index, load_valid_cell_index, save_valid_cell_index
+
+# Entry directories are named by `compute_cache_key`, a sha256 hex digest
+_ENTRY_NAME = re.compile(r"^[0-9a-f]{64}(\.tmp)?$")
+
+# Ingestion arguments that do not change the arrays and so are left out of the key
+_KEY_NEUTRAL_ARGUMENTS = ("max_workers", "plot_directory")
+
+
+def compute_cache_key(tiff_files, tiff_directory, india_shape, start_year, end_year, missing_files=(),
+                      ingest_kwargs=None):
+    """
+    Computes a hash that identifies one ingestion of the monthly TIFFs.
+
+    The key covers the source file names, their sizes and modification times, the
+    mask geometry and CRS, the missing-file list and the year range, so any change
+    to the inputs produces a new key. Ingestion options such as `dtype` are part
+    of the key as well.
+
+    Parameters:
+    ----------
+    tiff_files : list
+        Names of the TIFF files in `tiff_directory`.
+    tiff_directory : str
+        Directory containing the TIFF files.
+    india_shape : geopandas.GeoDataFrame
+        The shapes used to mask the TIFFs.
+    start_year : int
+        The first year of the dataset.
+    end_year : int
+        The last year of the dataset.
+    missing_files : list, optional
+        File names skipped during ingestion.
+    ingest_kwargs : dict, optional
+        Extra keyword arguments passed to `create_monthly_3d_arrays_with_mask`.
+
+    Returns:
+    -------
+    str
+        A hex digest identifying the cache entry.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{start_year}-{end_year}".encode())
+
+    for file in sorted(tiff_files):
+        stat = os.stat(os.path.join(tiff_directory, file))
+        digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    for file in sorted(missing_files):
+        digest.update(f"missing:{file}".encode())
+
+    digest.update(str(india_shape.crs).encode())
+    for geometry in india_shape.geometry:
+        digest.update(geometry.wkb)
+
+    for name, value in sorted((ingest_kwargs or {}).items()):
+        if name in _KEY_NEUTRAL_ARGUMENTS:
+            continue
+        if name == "dtype":
+            value = np.dtype(value).str
+        digest.update(f"option:{name}={value!r}".encode())
+
+    return digest.hexdigest()
+
+
+def save_monthly_arrays(cache_directory, monthly_arrays, metadata=None):
+    """
+    Writes the monthly 3D arrays to `cache_directory` as one .npy file per month,
+    along with the index of cells that hold any finite data.
+
+    The files are written to a temporary directory first and renamed into place,
+    so a crash never leaves a half-written entry behind.
+
+    Parameters:
+    ----------
+    cache_directory : str
+        Directory of the cache entry.
+    monthly_arrays : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays.
+    metadata : dict, optional
+        Extra JSON-serialisable information stored alongside the arrays.
+    """
+    temp_directory = f"{cache_directory}.tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    for month, array in monthly_arrays.items():
+        np.save(os.path.join(temp_directory, f"month_{month:02d}.npy"), np.asarray(array))
+
+    grid_shape = next(iter(monthly_arrays.values())).shape[:2]
+    save_valid_cell_index(
+        os.path.join(temp_directory, "valid_cells.npz"), build_valid_cell_index(monthly_arrays), grid_shape
+    )
+
+    with open(os.path.join(temp_directory, "metadata.json"), "w") as f:
+        json.dump({"months": sorted(monthly_arrays), **(metadata or {})}, f, indent=2)
+
+    shutil.rmtree(cache_directory, ignore_errors=True)
+    os.replace(temp_directory, cache_directory)
+
+
+def open_monthly_arrays(cache_directory, mmap_mode="r"):
+    """
+    Opens a cache entry written by `save_monthly_arrays` without loading it into memory.
+
+    Parameters:
+    ----------
+    cache_directory : str
+        Directory of the cache entry.
+    mmap_mode : str, optional
+        Memory-map mode passed to `np.load` ("r" for read-only, "r+" to update in place).
+
+    Returns:
+    -------
+    dict
+        A dictionary where keys are months (1-12) and values are memory-mapped 3D arrays.
+    """
+    with open(os.path.join(cache_directory, "metadata.json")) as f:
+        metadata = json.load(f)
+
+    return {
+        month: np.load(os.path.join(cache_directory, f"month_{month:02d}.npy"), mmap_mode=mmap_mode)
+        for month in metadata["months"]
+    }
+
+
+def open_valid_cell_index(cache_directory):
+    """Returns the flat valid-cell indices stored in a cache entry."""
+    valid_cells, _ = load_valid_cell_index(os.path.join(cache_directory, "valid_cells.npz"))
+    return valid_cells
+
+
+def load_or_create_monthly_arrays(tiff_files, missing_files, start_year, end_year, tiff_directory, india_shape,
+                                  cache_root, **ingest_kwargs):
+    """
+    Returns the monthly 3D arrays from the on-disk cache, ingesting the TIFFs only on a miss.
+
+    Entries live in `cache_root/<key>` where the key comes from `compute_cache_key`.
+    When the inputs change, the new entry is created and stale entries (directories
+    named by a cache key) are removed; other contents of `cache_root` are left alone.
+    A `plot_directory` does not change the key; its plots are written on a hit as
+    well as on a miss.
+
+    Parameters:
+    ----------
+    tiff_files, missing_files, start_year, end_year, tiff_directory, india_shape :
+        Same as `create_monthly_arrays.create_monthly_3d_arrays_with_mask`.
+    cache_root : str
+        Directory holding the cache entries.
+    **ingest_kwargs :
+        Extra keyword arguments for `create_monthly_3d_arrays_with_mask`.
+
+    Returns:
+    -------
+    dict
+        A dictionary where keys are months (1-12) and values are memory-mapped 3D arrays.
+    """
+    key = compute_cache_key(
+        tiff_files, tiff_directory, india_shape, start_year, end_year, missing_files, ingest_kwargs
+    )
+    cache_directory = os.path.join(cache_root, key)
+
+    if os.path.exists(os.path.join(cache_directory, "metadata.json")):
+        print(f"Using cached monthly arrays: {cache_directory}")
+        monthly_arrays = open_monthly_arrays(cache_directory)
+        if ingest_kwargs.get("plot_directory") is not None:
+            from create_monthly_arrays import save_monthly_plots
+
+            save_monthly_plots(monthly_arrays, start_year, ingest_kwargs["plot_directory"])
+        return monthly_arrays
+
+    from create_monthly_arrays import create_monthly_3d_arrays_with_mask
+
+    monthly_arrays = create_monthly_3d_arrays_with_mask(
+        tiff_files, missing_files, start_year, end_year, tiff_directory, india_shape, **ingest_kwargs
+    )
+    if monthly_arrays is None:
+        return None
+
+    os.makedirs(cache_root, exist_ok=True)
+    save_monthly_arrays(cache_directory, monthly_arrays, {"start_year": start_year, "end_year": end_year})
+
+    # Drop entries for inputs that no longer exist; anything not named like an entry is left alone
+    for entry in os.listdir(cache_root):
+        path = os.path.join(cache_root, entry)
+        if entry != key and _ENTRY_NAME.match(entry) and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    print(f"Cached monthly arrays: {cache_directory}")
+    return open_monthly_arrays(cache_directory)
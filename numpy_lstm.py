@@ -0,0 +1,145 @@
+import numpy as np
+
+_ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "linear": lambda x: x,
+    # tanh form of the logistic function; does not overflow for large |x|
+    "sigmoid": lambda x: 0.5 * (1 + np.tanh(0.5 * x)),
+}
+
+
+def export_lstm_weights(model, path):
+    """
+    Saves the weights of a model built by `build_lstm_model` to a compact .npz file.
+
+    Parameters:
+    ----------
+    model : tf.keras.Model
+        A trained model with one LSTM layer followed by one Dense layer.
+    path : str
+        Destination of the .npz file.
+    """
+    lstm, dense = model.layers[0], model.layers[-1]
+    kernel, recurrent_kernel, bias = lstm.get_weights()
+    dense_kernel, dense_bias = dense.get_weights()
+    np.savez(
+        path,
+        kernel=kernel.astype(np.float32),
+        recurrent_kernel=recurrent_kernel.astype(np.float32),
+        bias=bias.astype(np.float32),
+        dense_kernel=dense_kernel.astype(np.float32),
+        dense_bias=dense_bias.astype(np.float32),
+        activation=np.array(lstm.get_config()["activation"]),
+        recurrent_activation=np.array(lstm.get_config()["recurrent_activation"]),
+    )
+    print(f"Exported LSTM weights: {path}")
+
+
+class NumpyLSTMModel:
+    """
+    NumPy-only forward pass of the LSTM + Dense model exported by `export_lstm_weights`.
+
+    It follows the Keras LSTM recurrence (gate order input, forget, cell, output) and
+    evaluates every sample of a batch at once with matrix products, so inference
+    needs neither TensorFlow nor a GPU. It exposes `predict` and `predict_on_batch`
+    so it can be passed wherever the Keras model is used for inference.
+    """
+
+    def __init__(self, kernel, recurrent_kernel, bias, dense_kernel, dense_bias,
+                 activation="relu", recurrent_activation="sigmoid"):
+        self.kernel = kernel
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.dense_kernel = dense_kernel
+        self.dense_bias = dense_bias
+        self.units = recurrent_kernel.shape[0]
+        self.activation = _ACTIVATIONS[activation]
+        self.recurrent_activation = _ACTIVATIONS[recurrent_activation]
+
+    @classmethod
+    def load(cls, path):
+        """Loads a model from a .npz file written by `export_lstm_weights`."""
+        with np.load(path) as weights:
+            return cls(
+                weights["kernel"], weights["recurrent_kernel"], weights["bias"],
+                weights["dense_kernel"], weights["dense_bias"],
+                activation=str(weights["activation"]),
+                recurrent_activation=str(weights["recurrent_activation"]),
+            )
+
+    def predict_on_batch(self, inputs):
+        """
+        Runs the forward pass on one batch.
+
+        Parameters:
+        ----------
+        inputs : np.ndarray
+            Input sequences of shape (n_samples, sequence_length, n_features).
+
+        Returns:
+        -------
+        np.ndarray
+            Predictions of shape (n_samples, 1).
+        """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        n_samples, sequence_length, _ = inputs.shape
+        units = self.units
+
+        # Input projections for every time step in one product: (n_samples, sequence_length, 4 * units)
+        projected = inputs @ self.kernel + self.bias
+
+        hidden = np.zeros((n_samples, units), dtype=np.float32)
+        cell = np.zeros((n_samples, units), dtype=np.float32)
+        for t in range(sequence_length):
+            gates = projected[:, t] + hidden @ self.recurrent_kernel
+            input_gate = self.recurrent_activation(gates[:, :units])
+            forget_gate = self.recurrent_activation(gates[:, units:2 * units])
+            candidate = self.activation(gates[:, 2 * units:3 * units])
+            output_gate = self.recurrent_activation(gates[:, 3 * units:])
+            cell = forget_gate * cell + input_gate * candidate
+            hidden = output_gate * self.activation(cell)
+
+        return hidden @ self.dense_kernel + self.dense_bias
+
+    def predict(self, inputs, batch_size=65536, verbose=0):
+        """Runs the forward pass in chunks of `batch_size` samples, mirroring `tf.keras.Model.predict`."""
+        inputs = np.asarray(inputs, dtype=np.float32)
+        outputs = np.empty((len(inputs), self.dense_kernel.shape[1]), dtype=np.float32)
+        for start in range(0, len(inputs), batch_size):
+            outputs[start:start + batch_size] = self.predict_on_batch(inputs[start:start + batch_size])
+        return outputs
+
+
+def verify_against_keras(model, numpy_model, inputs, rtol=1e-4, atol=1e-3):
+    """
+    Checks that the NumPy backend reproduces `model.predict` on `inputs`.
+
+    Parameters:
+    ----------
+    model : tf.keras.Model
+        The trained Keras model.
+    numpy_model : NumpyLSTMModel
+        The model loaded from the exported weights.
+    inputs : np.ndarray
+        Sample input sequences of shape (n_samples, sequence_length, 1).
+    rtol, atol : float, optional
+        Tolerances passed to `np.allclose`.
+
+    Returns:
+    -------
+    float
+        The largest absolute difference between the two backends.
+
+    Raises:
+    ------
+    ValueError
+        If the predictions differ by more than the tolerance.
+    """
+    expected = model.predict(inputs, verbose=0)
+    actual = numpy_model.predict(inputs)
+    max_difference = float(np.max(np.abs(expected - actual))) if len(inputs) else 0.0
+    if not np.allclose(expected, actual, rtol=rtol, atol=atol):
+        raise ValueError(f"NumPy backend differs from Keras by up to {max_difference:.6g}")
+    print(f"NumPy backend matches Keras (max abs difference {max_difference:.3g}).")
+    return max_difference
@@ -0,0 +1,298 @@
+"""
+Runs the gap-filling workflow as one process:
+
+    ingest -> gaps -> sequences -> train -> interpolate -> write
+
+Every stage's output is stored under the cache directory, keyed by a fingerprint of
+the configuration values the stage reads plus the fingerprints of the stages it
+depends on. A stage whose fingerprint is unchanged is loaded from the cache instead
+of re-run, so changing only output options re-runs only the write stage. Heavy
+libraries (TensorFlow, rasterio, geopandas, matplotlib) are imported inside the
+stages that need them.
+
+Usage:
+    python pipeline.py --config pipeline.json
+    python pipeline.py --config pipeline.json --stop-after train
+    python pipeline.py --config pipeline.json --force train
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+DEFAULT_CONFIG = {
+    "tiff_directory": "dummy/path/GRACE_DATA/TIFFs",
+    "shapefile": "dummy/path/India_Shapefiles/Indian_States.shp",
+    "start_year": 2003,
+    "end_year": 2021,
+    "missing_files": [],
+    # {month: year or [years]}, or "auto" to detect every gap from the TIFFs
+    "missing_years": {
+        "1": 2018, "2": 2018, "3": 2018, "4": 2018, "5": 2018,
+        "7": 2017, "8": 2017, "9": 2017, "10": 2017, "11": 2017, "12": 2017,
+    },
+    "sequence_length": 6,
+    "epochs": 50,
+    "batch_size": 150,
+    "validation_split": 0.1,
+    "early_stopping_patience": 5,
+    "checkpoint_every": 1,
+    "inference_backend": "numpy",
+    "inference_batch_size": 65536,
+    "reference_file": "path/to/global_tws_file.tif",
+    "output_directory": "path/to/output_directory",
+    "output_format": "cog",  # "gtiff", "cog", "stack" (multi-band COG) or "netcdf"
+    "render_previews": True,
+    "preview_workers": None,
+    "cache_directory": ".pipeline_cache",
+}
+
+
+def _source_fingerprint(config):
+    """Hashes the names, sizes and mtimes of the TIFFs and shapefile components."""
+    digest = hashlib.sha256()
+    tiff_directory = config["tiff_directory"]
+    for file in sorted(f for f in os.listdir(tiff_directory) if f.endswith(".tif")):
+        stat = os.stat(os.path.join(tiff_directory, file))
+        digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    shapefile_stem = os.path.splitext(config["shapefile"])[0]
+    shapefile_directory = os.path.dirname(config["shapefile"]) or "."
+    for file in sorted(os.listdir(shapefile_directory)):
+        path = os.path.join(shapefile_directory, file)
+        if os.path.splitext(path)[0] == shapefile_stem:
+            stat = os.stat(path)
+            digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def _missing_indices(stage_directory):
+    with open(os.path.join(stage_directory, "missing_indices.json")) as f:
+        return {int(month): index for month, index in json.load(f).items()}
+
+
+# Each stage reads its upstream outputs from their stage directories and writes its own to `stage_directory`
+
+def run_ingest(config, inputs, stage_directory):
+    import geopandas as gpd
+
+    from create_monthly_arrays import create_monthly_3d_arrays_with_mask
+    from monthly_array_cache import save_monthly_arrays
+
+    india_shape = gpd.read_file(config["shapefile"])
+    tiff_files = sorted(f for f in os.listdir(config["tiff_directory"]) if f.endswith(".tif"))
+    monthly_arrays = create_monthly_3d_arrays_with_mask(
+        tiff_files, config["missing_files"], config["start_year"], config["end_year"],
+        config["tiff_directory"], india_shape
+    )
+    if monthly_arrays is None:
+        raise FileNotFoundError(f"No valid TIFF files found in {config['tiff_directory']}.")
+    save_monthly_arrays(stage_directory, monthly_arrays, {
+        "start_year": config["start_year"], "end_year": config["end_year"],
+    })
+
+
+def run_gaps(config, inputs, stage_directory):
+    from calculate_missing_indices_of_monthly_arrays import (
+        build_availability_matrix,
+        calculate_missing_indices,
+        mark_unpublished_months_available,
+        missing_indices_from_availability,
+    )
+    from monthly_array_cache import open_monthly_arrays
+
+    if config["missing_years"] == "auto":
+        # Every month missing from the listing or empty in the cube is a gap, except
+        # the months after the latest file, which are not published yet
+        availability = build_availability_matrix(
+            os.listdir(config["tiff_directory"]), config["start_year"], config["end_year"],
+            open_monthly_arrays(inputs["ingest"])
+        )
+        missing_indices = missing_indices_from_availability(mark_unpublished_months_available(availability))
+    else:
+        missing_years = {int(month): year for month, year in config["missing_years"].items()}
+        missing_indices = calculate_missing_indices(config["start_year"], config["end_year"], missing_years)
+    with open(os.path.join(stage_directory, "missing_indices.json"), "w") as f:
+        json.dump(missing_indices, f, indent=2)
+
+
+def run_sequences(config, inputs, stage_directory):
+    from monthly_array_cache import open_monthly_arrays, open_valid_cell_index
+    from prepare_train_test_data import prepare_sequences_for_all_months
+
+    sequences, targets = prepare_sequences_for_all_months(
+        open_monthly_arrays(inputs["ingest"]), _missing_indices(inputs["gaps"]), config["sequence_length"],
+        report_memory=True, valid_cells=open_valid_cell_index(inputs["ingest"])
+    )
+    np.save(os.path.join(stage_directory, "sequences.npy"), sequences)
+    np.save(os.path.join(stage_directory, "targets.npy"), targets)
+
+
+def run_train(config, inputs, stage_directory):
+    from numpy_lstm import export_lstm_weights
+    from training_harness import train_with_harness
+
+    sequences = np.load(os.path.join(inputs["sequences"], "sequences.npy"), mmap_mode="r")
+    targets = np.load(os.path.join(inputs["sequences"], "targets.npy"), mmap_mode="r")
+
+    # Checkpoints and the training log live next to the stage directory, which is
+    # wiped on every run, so a crashed training run resumes from its last checkpoint.
+    # `run_pipeline` deletes them when the stage is forced and once it has finished.
+    checkpoint_directory = f"{stage_directory}-checkpoints"
+    model, _ = train_with_harness(
+        sequences[..., np.newaxis], targets, checkpoint_directory, epochs=config["epochs"],
+        batch_size=config["batch_size"], validation_split=config["validation_split"],
+        patience=config["early_stopping_patience"], checkpoint_every=config["checkpoint_every"]
+    )
+    shutil.copy(os.path.join(checkpoint_directory, "training_log.json"), stage_directory)
+    model.save(os.path.join(stage_directory, "model.keras"))
+    export_lstm_weights(model, os.path.join(stage_directory, "lstm_weights.npz"))
+
+
+def run_interpolate(config, inputs, stage_directory):
+    from interpolation_using_trained_model import interpolate_missing_data_with_lstm_batched
+    from monthly_array_cache import open_monthly_arrays, open_valid_cell_index, save_monthly_arrays
+    from tiled_interpolation import load_inference_model
+
+    if config["inference_backend"] == "numpy":
+        model = load_inference_model(os.path.join(inputs["train"], "lstm_weights.npz"))
+    else:
+        model = load_inference_model(os.path.join(inputs["train"], "model.keras"))
+
+    interpolated = interpolate_missing_data_with_lstm_batched(
+        model, open_monthly_arrays(inputs["ingest"]), _missing_indices(inputs["gaps"]), config["sequence_length"],
+        batch_size=config["inference_batch_size"], valid_cells=open_valid_cell_index(inputs["ingest"])
+    )
+    save_monthly_arrays(stage_directory, interpolated, {"start_year": config["start_year"]})
+
+
+def run_write(config, inputs, stage_directory):
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    from monthly_array_cache import open_monthly_arrays
+    import plot_save_interpolated_data
+
+    # The output stage reads its inputs from module-level settings
+    plot_save_interpolated_data.global_tws_file = config["reference_file"]
+    plot_save_interpolated_data.output_directory = config["output_directory"]
+    plot_save_interpolated_data.start_year = config["start_year"]
+    plot_save_interpolated_data.output_format = config["output_format"]
+    plot_save_interpolated_data.render_previews = config["render_previews"]
+    plot_save_interpolated_data.preview_workers = config["preview_workers"]
+    plot_save_interpolated_data.missing_indices = _missing_indices(inputs["gaps"])
+    plot_save_interpolated_data.interpolated_monthly_india_data = open_monthly_arrays(inputs["interpolate"])
+    plot_save_interpolated_data.process_and_save_interpolated_data()
+
+
+# name -> (upstream stages, configuration keys read, function)
+STAGES = {
+    "ingest": ((), ("tiff_directory", "shapefile", "start_year", "end_year", "missing_files"), run_ingest),
+    "gaps": (("ingest",), ("start_year", "end_year", "missing_years"), run_gaps),
+    "sequences": (("ingest", "gaps"), ("sequence_length",), run_sequences),
+    "train": (
+        ("sequences",),
+        ("sequence_length", "epochs", "batch_size", "validation_split", "early_stopping_patience", "checkpoint_every"),
+        run_train
+    ),
+    "interpolate": (
+        ("ingest", "gaps", "train"), ("sequence_length", "inference_backend", "inference_batch_size"),
+        run_interpolate
+    ),
+    "write": (
+        ("gaps", "interpolate"),
+        ("reference_file", "output_directory", "start_year", "output_format", "render_previews", "preview_workers"),
+        run_write
+    ),
+}
+
+
+def stage_fingerprint(name, config, upstream_fingerprints):
+    """Hashes the configuration values a stage reads and the fingerprints of its upstream stages."""
+    _, keys, _ = STAGES[name]
+    payload = {
+        "stage": name,
+        "config": {key: config[key] for key in keys},
+        "upstream": upstream_fingerprints,
+    }
+    if name == "ingest":
+        payload["sources"] = _source_fingerprint(config)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _remove_stale_stage_directories(cache_directory, name, stage_directory):
+    """Deletes the outputs (and leftover checkpoints) of earlier fingerprints of stage `name`."""
+    pattern = re.compile(rf"^{re.escape(name)}-[0-9a-f]{{16}}(-checkpoints)?$")
+    current = os.path.basename(stage_directory)
+    for entry in os.listdir(cache_directory):
+        if pattern.match(entry) and entry != current:
+            shutil.rmtree(os.path.join(cache_directory, entry), ignore_errors=True)
+
+
+def run_pipeline(config, stop_after=None, force=()):
+    """
+    Runs the stages in order, reusing cached outputs whose fingerprint is unchanged.
+
+    Parameters:
+    config (dict): Pipeline configuration (see `DEFAULT_CONFIG`).
+    stop_after (str, optional): Name of the last stage to run.
+    force (iterable): Names of stages to re-run even if cached; downstream stages follow.
+
+    Returns:
+    dict: Stage names mapped to their output directories.
+    """
+    config = {**DEFAULT_CONFIG, **config}
+    cache_directory = config["cache_directory"]
+    os.makedirs(cache_directory, exist_ok=True)
+
+    fingerprints = {}
+    directories = {}
+    for name, (upstream, _, function) in STAGES.items():
+        fingerprints[name] = stage_fingerprint(name, config, {stage: fingerprints[stage] for stage in upstream})
+        stage_directory = os.path.join(cache_directory, f"{name}-{fingerprints[name][:16]}")
+        directories[name] = stage_directory
+        done_marker = os.path.join(stage_directory, ".done")
+
+        if name in force or not os.path.exists(done_marker):
+            print(f"[{name}] running -> {stage_directory}")
+            shutil.rmtree(stage_directory, ignore_errors=True)
+            if name in force:
+                # A forced stage starts over instead of resuming an earlier attempt
+                shutil.rmtree(f"{stage_directory}-checkpoints", ignore_errors=True)
+            os.makedirs(stage_directory)
+            function(config, {stage: directories[stage] for stage in upstream}, stage_directory)
+            open(done_marker, "w").close()
+            shutil.rmtree(f"{stage_directory}-checkpoints", ignore_errors=True)
+            _remove_stale_stage_directories(cache_directory, name, stage_directory)
+            # Cached outputs of a forced stage are rebuilt, so downstream stages must re-run too
+            if name in force:
+                force = set(force) | {stage for stage, (deps, _, _) in STAGES.items() if name in deps}
+        else:
+            print(f"[{name}] cached ({stage_directory})")
+
+        if name == stop_after:
+            break
+
+    return directories
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", help="JSON file overriding the default configuration.")
+    parser.add_argument("--stop-after", choices=list(STAGES), help="Last stage to run.")
+    parser.add_argument("--force", choices=list(STAGES), action="append", default=[],
+                        help="Re-run a stage even if it is cached; repeatable.")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    run_pipeline(config, stop_after=args.stop_after, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import rasterio
 from rasterio.mask import mask
 import numpy as np
-import matplotlib.pyplot as plt
+
+from calculate_missing_indices_of_monthly_arrays import iter_missing_indices
 
 # Placeholder for user-defined inputs
 # Update with your actual paths or logic
@@ -10,83 +15,238 @@ global_tws_file = 'path/to/global_tws_file.tif'  # Example global TWS file
 gws_anomaly_file = 'path/to/gws_anomaly_file.tif'  # Input GWS anomaly file
 india_geom = None  # Replace with actual geometry for clipping
 output_directory = 'path/to/output_directory'  # Directory to save interpolated files
-missing_indices = {}  # Dictionary with missing month-year mapping
+missing_indices = {}  # Dictionary with missing month-year mapping (an index or a list of indices per month)
 interpolated_monthly_india_data = None  # 3D array with interpolated data
+start_year = 2003  # Year of time index 0
+output_format = 'cog'  # 'gtiff', 'cog' (one Cloud-Optimized GeoTIFF per month), 'stack' (one multi-band COG) or 'netcdf'
+render_previews = True  # Save a PNG preview of every filled month
+preview_workers = None  # Processes rendering the previews (default: number of CPUs; 0 renders in this process)
 
-# Ensure the output directory exists
-os.makedirs(output_directory, exist_ok=True)
+OUTPUT_FORMATS = ('gtiff', 'cog', 'stack', 'netcdf')
 
 # Function to generate longitude and latitude arrays
+@lru_cache(maxsize=8)
 def generate_lon_lat_arrays(transform, shape):
-    """Generate longitude and latitude grids from transform and shape."""
+    """
+    Generate longitude and latitude grids of pixel centers from transform and shape.
+
+    The grids are computed with one affine operation and cached per (transform, shape);
+    the returned arrays are read-only because they are shared between callers.
+    """
     nrows, ncols = shape
-    lon = np.zeros((nrows, ncols))
-    lat = np.zeros((nrows, ncols))
-    for row in range(nrows):
-        for col in range(ncols):
-            lon[row, col], lat[row, col] = rasterio.transform.xy(transform, row, col)
+    cols, rows = np.meshgrid(np.arange(ncols) + 0.5, np.arange(nrows) + 0.5)
+    lon = transform.a * cols + transform.b * rows + transform.c
+    lat = transform.d * cols + transform.e * rows + transform.f
+    lon.flags.writeable = False
+    lat.flags.writeable = False
     return lon, lat
 
+def grid_extent(transform, shape):
+    """Return the [lon_min, lon_max, lat_min, lat_max] extent of the pixel centers."""
+    nrows, ncols = shape
+    corners = np.array([[0.5, 0.5], [ncols - 0.5, 0.5], [0.5, nrows - 0.5], [ncols - 0.5, nrows - 0.5]])
+    lon = transform.a * corners[:, 0] + transform.b * corners[:, 1] + transform.c
+    lat = transform.d * corners[:, 0] + transform.e * corners[:, 1] + transform.f
+    return [lon.min(), lon.max(), lat.min(), lat.max()]
+
+# Function to read the output profile once per reference file
+@lru_cache(maxsize=None)
+def load_output_profile(reference_file):
+    """
+    Read the CRS and transform of `reference_file` into a reusable single-band GeoTIFF profile.
+
+    Outputs are float32 with NaN as their nodata value, so readers get a proper mask.
+    """
+    with rasterio.open(reference_file) as src:
+        return {
+            'driver': 'GTiff',
+            'count': 1,
+            'crs': src.crs,
+            'transform': src.transform,
+            'nodata': np.nan,
+        }
+
+@lru_cache(maxsize=None)
+def load_reference_nodata(reference_file):
+    """Return the nodata value declared by `reference_file`, or None."""
+    with rasterio.open(reference_file) as src:
+        return src.nodata
+
+def mask_nodata(array, nodata=None):
+    """Return a float32 copy of `array` with NaN wherever it is not finite or equals `nodata`."""
+    masked = np.array(array, dtype=np.float32)
+    if nodata is not None and np.isfinite(nodata):
+        masked[masked == np.float32(nodata)] = np.nan
+    masked[~np.isfinite(masked)] = np.nan
+    return masked
+
 # Function to save interpolated data as a TIFF file
-def save_interpolated_tiff(output_path, array, transform, crs):
-    """Save a 2D array as a GeoTIFF file."""
+def save_interpolated_tiff(output_path, array, profile):
+    """Save a 2D array as a GeoTIFF file using a prepared profile."""
     with rasterio.open(
         output_path, 'w',
-        driver='GTiff',
         height=array.shape[0],
         width=array.shape[1],
-        count=1,
         dtype=array.dtype,
-        crs=crs,
-        transform=transform,
+        **profile,
     ) as dst:
         dst.write(array, 1)
     print(f"Saved interpolated TIFF: {output_path}")
 
+def _overview_levels(shape, blocksize):
+    """Overview factors (2, 4, ...) until the overview fits in one block."""
+    levels = []
+    factor = 2
+    while max(shape) / (factor // 2) > blocksize and min(shape) // factor >= 1:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+# Function to save one or more bands as a Cloud-Optimized GeoTIFF
+def write_cog(output_path, bands, profile, band_names=None, compress='deflate', blocksize=256,
+              overview_levels=None, resampling='average'):
+    """
+    Save 2D arrays as one tiled, compressed Cloud-Optimized GeoTIFF with overviews.
+
+    The bands and their overviews are built in memory, then copied into the final
+    file with the overviews ahead of the full-resolution tiles, which is the COG layout.
+
+    Parameters:
+    output_path (str): Destination of the file.
+    bands (np.ndarray): A 2D array, or a (count, rows, cols) stack.
+    profile (dict): Profile from `load_output_profile`.
+    band_names (list, optional): Description of every band, e.g. "2017-07".
+    compress (str): GeoTIFF compression.
+    blocksize (int): Tile size in pixels (a multiple of 16).
+    overview_levels (list, optional): Overview factors; by default halved until one tile covers the grid.
+    resampling (str): Resampling used for the overviews.
+    """
+    from rasterio.enums import Resampling
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy as copy_dataset
+
+    bands = np.asarray(bands, dtype=np.float32)
+    if bands.ndim == 2:
+        bands = bands[np.newaxis]
+    count, height, width = bands.shape
+    if overview_levels is None:
+        overview_levels = _overview_levels((height, width), blocksize)
+
+    tiling = {'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize}
+    with MemoryFile() as memfile:
+        with memfile.open(**{**profile, 'count': count}, height=height, width=width, dtype='float32',
+                          **tiling) as mem:
+            mem.write(bands)
+            for band, name in enumerate(band_names or [], start=1):
+                mem.set_band_description(band, name)
+            if overview_levels:
+                mem.build_overviews(overview_levels, Resampling[resampling])
+                mem.update_tags(ns='rio_overview', resampling=resampling)
+
+            copy_dataset(mem, output_path, driver='GTiff', compress=compress, predictor=3,
+                         copy_src_overviews=True, **tiling)
+    print(f"Saved Cloud-Optimized GeoTIFF: {output_path}")
+
+# Function to save every filled month as one NetCDF stack
+def write_netcdf_stack(output_path, bands, band_names, transform):
+    """Save a (time, rows, cols) stack as compressed NetCDF with time, lat and lon coordinates."""
+    import xarray as xr
+
+    lon, lat = generate_lon_lat_arrays(transform, bands.shape[1:])
+    dataset = xr.Dataset(
+        {'twsa': (('time', 'lat', 'lon'), np.asarray(bands, dtype=np.float32), {'units': 'cm'})},
+        coords={
+            'time': np.array(band_names, dtype='datetime64[M]').astype('datetime64[ns]'),
+            'lat': lat[:, 0],
+            'lon': lon[0, :],
+        },
+    )
+    dataset.to_netcdf(output_path, encoding={'twsa': {'zlib': True, 'complevel': 4, '_FillValue': np.nan}})
+    print(f"Saved NetCDF stack: {output_path}")
+
+# Function to render one PNG preview without a display
+def render_preview(png_path, array, extent, title, vmin=-250, vmax=30):
+    """Render a map of `array` to `png_path` with the Agg canvas; no pyplot state or display is used."""
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(10, 6))
+    axes = figure.subplots()
+    image = axes.imshow(array, cmap='viridis', interpolation='nearest', extent=extent, vmin=vmin, vmax=vmax)
+    figure.colorbar(image, ax=axes, label='TWSA (cm)')
+    axes.set_title(title)
+    axes.set_xlabel('Longitude')
+    axes.set_ylabel('Latitude')
+    figure.savefig(png_path)
+    return png_path
+
+def render_previews_in_pool(jobs, max_workers=None):
+    """Render (png_path, array, extent, title) jobs across a process pool, or serially when max_workers is 0."""
+    if max_workers == 0:
+        return [render_preview(*job) for job in jobs]
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+        return list(executor.map(render_preview, *zip(*jobs)))
+
 # Main logic to process and save interpolated data
 def process_and_save_interpolated_data():
-    """Process and save interpolated data for missing months and years."""
+    """
+    Save the interpolated data for missing months and years in `output_format`,
+    with optional PNG previews rendered headless in a worker pool.
+    """
     if interpolated_monthly_india_data is None or not missing_indices:
         raise ValueError("Missing required data: interpolated_monthly_india_data or missing_indices.")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}.")
+
+    # Ensure the output directory exists
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Retrieve CRS, transform and nodata value from the global TWS file
+    profile = load_output_profile(global_tws_file)
+    global_transform = profile['transform']
+    source_nodata = load_reference_nodata(global_tws_file)
+
+    # Filled months in calendar order
+    filled = sorted(
+        iter_missing_indices(missing_indices), key=lambda item: (item[1], item[0])
+    )
+    bands = []
+    names = []
+    preview_jobs = []
+    for month, missing_index in filled:
+        interpolated_2d = mask_nodata(interpolated_monthly_india_data[month][:, :, missing_index], source_nodata)
+        year = start_year + missing_index
+        output_stem = os.path.join(output_directory, f"India_TWSA_{year}_{month:02d}")
+
+        if output_format == 'gtiff':
+            save_interpolated_tiff(f"{output_stem}.tif", interpolated_2d, profile)
+        elif output_format == 'cog':
+            write_cog(f"{output_stem}.tif", interpolated_2d, profile, band_names=[f"{year}-{month:02d}"])
+        else:
+            bands.append(interpolated_2d)
+            names.append(f"{year}-{month:02d}")
+
+        if render_previews:
+            # Set plot extent from the pixel-center coordinates of the grid corners
+            extent = grid_extent(global_transform, interpolated_2d.shape)
+            preview_jobs.append(
+                (f"{output_stem}.png", interpolated_2d, extent, f'Predicted TWSA for India: {year}-{month:02d}')
+            )
+
+    if output_format == 'stack':
+        write_cog(os.path.join(output_directory, "India_TWSA_filled.tif"), np.stack(bands), profile, band_names=names)
+    elif output_format == 'netcdf':
+        write_netcdf_stack(os.path.join(output_directory, "India_TWSA_filled.nc"), np.stack(bands), names,
+                           global_transform)
 
-    # Retrieve CRS and transform from the global TWS file
-    with rasterio.open(global_tws_file) as src:
-        global_transform = src.transform
-        global_crs = src.crs
-
-    # Loop through missing months and indices
-    for month, missing_index in missing_indices.items():
-        interpolated_array = interpolated_monthly_india_data[month]
-        interpolated_2d = interpolated_array[:, :, missing_index]
-        
-        # Replace nodata values with NaN
-        interpolated_2d_masked = np.array(interpolated_2d)
-        interpolated_2d_masked[interpolated_2d_masked == -12417.8330078125] = np.nan
-        
-        # Define output file path
-        year = 2003 + missing_index
-        output_path = os.path.join(output_directory, f"India_TWSA_{year}_{month:02d}.tif")
-        
-        # Save as GeoTIFF
-        save_interpolated_tiff(output_path, interpolated_2d_masked, global_transform, global_crs)
-        
-        # Generate and display longitude-latitude grids
-        lon, lat = generate_lon_lat_arrays(global_transform, interpolated_2d_masked.shape)
-        extent = [lon.min(), lon.max(), lat.min(), lat.max()]  # Set plot extent
-
-        # Plot the interpolated data
-        plt.figure(figsize=(10, 6))
-        plt.imshow(interpolated_2d_masked, cmap='viridis', interpolation='nearest', extent=extent, vmin=-250, vmax=30)
-        plt.colorbar(label='TWSA (cm)')
-        plt.title(f'Predicted TWSA for India: {year}-{month:02d}')
-        plt.xlabel('Longitude')
-        plt.ylabel('Latitude')
-        # Uncomment to save plots as PNG
-        # plt.savefig(os.path.join(output_directory, f"India_TWSA_{year}_{month:02d}.png"))
-        plt.show()
+    if preview_jobs:
+        render_previews_in_pool(preview_jobs, preview_workers)
+        print(f"Saved {len(preview_jobs)} PNG previews to {output_directory}")
 
 # Example execution
-try:
-    process_and_save_interpolated_data()
-except Exception as e:
-    print(f"An error occurred: {e}")
+if __name__ == "__main__":
+    try:
+        process_and_save_interpolated_data()
+    except Exception as e:
+        print(f"An error occurred: {e}")
@@ -1,8 +1,43 @@
+import itertools
+import tracemalloc
+
 import numpy as np
-import tensorflow as tf
-from sklearn.model_selection import train_test_split
+from numpy.lib.stride_tricks import sliding_window_view
+
+from cube_layout import as_cell_time_matrix
+
+
+def valid_windows(array, missing_time_index, sequence_length):
+    """
+    Builds zero-copy window views over the last (time) axis of `array` and the mask of usable windows.
+
+    `array` is either a (x, y, time) cube or its (cell, time) matrix. Returns the
+    (..., t, sequence_length) window view, the (..., t) target view and a boolean
+    (..., t) mask that is False for windows or targets containing NaN and for
+    windows whose target is `missing_time_index` (an index or a list of indices).
+    """
+    n_targets = max(array.shape[-1] - sequence_length, 0)
+
+    # Zero-copy (..., t, sequence_length) view of every window that has a target
+    windows = sliding_window_view(array, sequence_length, axis=-1)[..., :n_targets, :]
+    targets = array[..., sequence_length:]
+
+    # A window contains NaN when the running NaN count changes across it
+    nan_counts = np.concatenate(
+        [np.zeros(array.shape[:-1] + (1,), dtype=np.int32), np.cumsum(np.isnan(array), axis=-1, dtype=np.int32)],
+        axis=-1
+    )
+    valid = (nan_counts[..., sequence_length:-1] == nan_counts[..., :n_targets]) & ~np.isnan(targets)
 
-def prepare_sequences_for_month(monthly_data, month, missing_time_index, sequence_length):
+    # Skip sequences whose target is a missing time index
+    excluded = np.atleast_1d(missing_time_index) - sequence_length
+    valid[..., excluded[(excluded >= 0) & (excluded < n_targets)]] = False
+
+    return windows, targets, valid
+
+
+def prepare_sequences_for_month(monthly_data, month, missing_time_index, sequence_length, dtype=np.float32,
+                                valid_cells=None, return_cells=False):
     """
     Prepare sequences and targets for a specific month, excluding the missing time index.
 
@@ -12,77 +47,279 @@ def prepare_sequences_for_month(monthly_data, month, missing_time_index, sequenc
         A dictionary where keys are months (1-12) and values are 3D numpy arrays (time-index, x, y).
     month : int
         The month for which sequences and targets are prepared.
-    missing_time_index : int
-        The time index to exclude while preparing sequences.
+    missing_time_index : int or list of int
+        The time index, or indices, to exclude while preparing sequences.
     sequence_length : int
         The length of each input sequence.
+    dtype : numpy dtype, optional
+        The dtype of the returned arrays (default float32).
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to use (see `cube_layout.build_valid_cell_index`).
+        All cells are used when omitted.
+    return_cells : bool, optional
+        If True, also return the flat cell index of every sample.
 
     Returns:
     -------
     tuple
-        A tuple containing two numpy arrays: sequences and targets.
+        A tuple containing two contiguous numpy arrays: sequences and targets.
         - sequences: Array of input sequences (n_samples, sequence_length).
         - targets: Array of target values corresponding to sequences (n_samples,).
+        With `return_cells`, a third array holds the flat cell index of each sample.
+    """
+    array = as_cell_time_matrix(monthly_data[month])
+    cells = np.arange(array.shape[0]) if valid_cells is None else valid_cells
+    if valid_cells is not None:
+        array = array[valid_cells]
+    array = np.asarray(array, dtype=dtype)
+    if array.shape[1] <= sequence_length:
+        sequences, targets = np.empty((0, sequence_length), dtype=dtype), np.empty(0, dtype=dtype)
+        return (sequences, targets, np.empty(0, dtype=np.int64)) if return_cells else (sequences, targets)
+
+    windows, targets, valid = valid_windows(array, missing_time_index, sequence_length)
+    sequences, targets = np.ascontiguousarray(windows[valid]), np.ascontiguousarray(targets[valid])
+    if return_cells:
+        return sequences, targets, cells[np.nonzero(valid)[0]]
+    return sequences, targets
+
+
+def prepare_sequences_for_all_months(monthly_data, missing_indices, sequence_length, dtype=np.float32,
+                                     report_memory=False, valid_cells=None, return_index=False):
+    """
+    Prepare sequences and targets for every month in `missing_indices` and concatenate them.
+
+    Parameters:
+    ----------
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    missing_indices : dict
+        A dictionary where keys are months (1-12) and values are the time index, or list of
+        indices, to exclude.
+    sequence_length : int
+        The length of each input sequence.
+    dtype : numpy dtype, optional
+        The dtype of the returned arrays (default float32).
+    report_memory : bool, optional
+        If True, print the peak memory allocated while building the arrays.
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to use. All cells are used when omitted.
+    return_index : bool, optional
+        If True, also return the flat cell index and the month of every sample, which
+        the evaluation uses to build per-cell and per-month error maps.
+
+    Returns:
+    -------
+    tuple
+        A tuple containing two contiguous numpy arrays: sequences (n_samples, sequence_length)
+        and targets (n_samples,). With `return_index`, followed by cells and months (n_samples,).
+    """
+    if report_memory:
+        tracemalloc.start()
+
+    all_sequences = []
+    all_targets = []
+    all_cells = []
+    all_months = []
+    for month, missing_index in missing_indices.items():
+        sequences, targets, cells = prepare_sequences_for_month(
+            monthly_data, month, missing_index, sequence_length, dtype=dtype, valid_cells=valid_cells,
+            return_cells=True
+        )
+        all_sequences.append(sequences)
+        all_targets.append(targets)
+        all_cells.append(cells)
+        all_months.append(np.full(len(targets), month, dtype=np.int8))
+
+    if all_sequences:
+        all_sequences = np.concatenate(all_sequences, axis=0)
+        all_targets = np.concatenate(all_targets, axis=0)
+        all_cells = np.concatenate(all_cells)
+        all_months = np.concatenate(all_months)
+    else:
+        all_sequences = np.empty((0, sequence_length), dtype=dtype)
+        all_targets = np.empty(0, dtype=dtype)
+        all_cells = np.empty(0, dtype=np.int64)
+        all_months = np.empty(0, dtype=np.int8)
+
+    if report_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Peak memory while preparing sequences: {peak / 1024 ** 2:.1f} MiB")
+
+    if return_index:
+        return all_sequences, all_targets, all_cells, all_months
+    return all_sequences, all_targets
+
+
+def is_validation_cell(cell_ids, validation_fraction, seed):
+    """
+    Deterministically assigns grid cells to the validation split by hashing their flat index.
+
+    A cell in the split for one fraction is also in the split for every larger
+    fraction, so nested splits (e.g. validation and a separate holdout) can be
+    taken with two thresholds.
+    """
+    hashed = (cell_ids.astype(np.uint64) * np.uint64(2654435761) + np.uint64(seed)) % np.uint64(2 ** 32)
+    return hashed < np.uint64(validation_fraction * 2 ** 32)
+
+
+def iter_sequence_batches(monthly_data, missing_indices, sequence_length, batch_size=150, subset="train",
+                          validation_fraction=0.1, shuffle_buffer=100000, cells_per_block=4096, seed=42,
+                          dtype=np.float32, valid_cells=None, epoch=0):
+    """
+    Lazily yields (sequences, targets) batches from the monthly 3D arrays.
+
+    The arrays are walked in blocks of `cells_per_block` cells, so only one block of
+    windows and one shuffle buffer are ever held in memory. Cells are split between
+    training and validation by a hash of their flat index, which keeps the split
+    identical across epochs and runs and keeps every cell's series in one split.
+
+    Parameters:
+    ----------
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are 3D numpy arrays (x, y, time-index).
+    missing_indices : dict
+        A dictionary where keys are months (1-12) and values are the time index, or list of
+        indices, to exclude.
+    sequence_length : int
+        The length of each input sequence.
+    batch_size : int, optional
+        Number of samples per yielded batch.
+    subset : str, optional
+        "train" or "validation".
+    validation_fraction : float, optional
+        Fraction of grid cells assigned to the validation split.
+    shuffle_buffer : int, optional
+        Maximum number of samples shuffled together before being batched.
+    cells_per_block : int, optional
+        Number of grid cells turned into windows at a time.
+    seed : int, optional
+        Seed for the split hash and the shuffle.
+    dtype : numpy dtype, optional
+        The dtype of the yielded arrays (default float32).
+    valid_cells : np.ndarray, optional
+        Flat indices of the cells to use. All cells are used when omitted.
+    epoch : int, optional
+        Epoch number; mixed into the shuffle seed so every epoch sees a new order.
+
+    Yields:
+    ------
+    tuple
+        sequences of shape (batch_size, sequence_length, 1) and targets of shape (batch_size,).
     """
-    sequences = []
-    targets = []
-    array = monthly_data[month]
-
-    for x in range(array.shape[0]):  # Iterate over spatial x dimension
-        for y in range(array.shape[1]):  # Iterate over spatial y dimension
-            time_series = array[x, y, :]  # Extract the time series for the current grid cell
-            
-            for t in range(len(time_series) - sequence_length):
-                # Skip sequences that include the missing time index
-                if t + sequence_length == missing_time_index:
-                    continue
-                
-                seq = time_series[t:t + sequence_length]
-                target = time_series[t + sequence_length]
-                
-                # Exclude sequences or targets with NaN values
-                if not np.isnan(seq).any() and not np.isnan(target):
-                    sequences.append(seq)
-                    targets.append(target)
-
-    return np.array(sequences), np.array(targets)
-
-
-# Parameters
-sequence_length = 6  # Length of each sequence (choose on the basis of where the missing indices are in the array)
-all_sequences = []
-all_targets = []
-
-# Iterate through each month and prepare sequences
-for month, missing_index in missing_indices.items():
-    sequences, targets = prepare_sequences_for_month(
+    if subset not in ("train", "validation"):
+        raise ValueError(f"Unknown subset '{subset}', expected 'train' or 'validation'.")
+
+    # The split depends on `seed` only; the shuffle order also changes with `epoch`
+    rng = np.random.default_rng([seed, epoch])
+    buffered_sequences = []
+    buffered_targets = []
+    n_buffered = 0
+
+    def drain(flush):
+        nonlocal buffered_sequences, buffered_targets, n_buffered
+        sequences = np.concatenate(buffered_sequences)
+        targets = np.concatenate(buffered_targets)
+        order = rng.permutation(len(targets))
+        n_out = len(order) if flush else len(order) - len(order) % batch_size
+        for start in range(0, n_out, batch_size):
+            batch = order[start:start + batch_size]
+            yield sequences[batch][..., np.newaxis], targets[batch]
+        remainder = order[n_out:]
+        buffered_sequences, buffered_targets = [sequences[remainder]], [targets[remainder]]
+        n_buffered = len(remainder)
+
+    for month, missing_index in missing_indices.items():
+        matrix = as_cell_time_matrix(monthly_data[month])
+        if matrix.shape[1] <= sequence_length:
+            continue
+        cells = np.arange(matrix.shape[0]) if valid_cells is None else valid_cells
+
+        for block_start in range(0, len(cells), cells_per_block):
+            block_cells = cells[block_start:block_start + cells_per_block]
+            block = np.asarray(matrix[block_cells], dtype=dtype)
+            windows, targets, valid = valid_windows(block, missing_index, sequence_length)
+
+            cell_ids = block_cells[np.nonzero(valid)[0]]
+            in_validation = is_validation_cell(cell_ids, validation_fraction, seed)
+            keep = in_validation if subset == "validation" else ~in_validation
+            if not keep.any():
+                continue
+
+            buffered_sequences.append(windows[valid][keep])
+            buffered_targets.append(targets[valid][keep])
+            n_buffered += int(keep.sum())
+            if n_buffered >= shuffle_buffer:
+                yield from drain(flush=False)
+
+    if n_buffered:
+        yield from drain(flush=True)
+
+
+def make_streaming_datasets(monthly_data, missing_indices, sequence_length, batch_size=150,
+                            validation_fraction=0.1, shuffle_buffer=100000, seed=42, valid_cells=None):
+    """
+    Wraps `iter_sequence_batches` in prefetching tf.data pipelines.
+
+    Returns:
+    -------
+    tuple
+        (train_dataset, validation_dataset), each yielding batches of
+        (sequences (batch, sequence_length, 1), targets (batch,)) in float32.
+    """
+    import tensorflow as tf
+
+    signature = (
+        tf.TensorSpec(shape=(None, sequence_length, 1), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.float32),
+    )
+
+    def make_dataset(subset):
+        # tf.data calls the generator function once per epoch; count the calls so each epoch is shuffled anew
+        epochs = itertools.count()
+        dataset = tf.data.Dataset.from_generator(
+            lambda: iter_sequence_batches(
+                monthly_data, missing_indices, sequence_length, batch_size=batch_size, subset=subset,
+                validation_fraction=validation_fraction, shuffle_buffer=shuffle_buffer, seed=seed,
+                valid_cells=valid_cells, epoch=next(epochs)
+            ),
+            output_signature=signature
+        )
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    return make_dataset("train"), make_dataset("validation")
+
+
+if __name__ == "__main__":
+    from sklearn.model_selection import train_test_split
+
+    # Parameters
+    sequence_length = 6  # Length of each sequence (choose on the basis of where the missing indices are in the array)
+
+    # Prepare sequences for every month at once
+    all_sequences, all_targets, all_cells, all_months = prepare_sequences_for_all_months(
         monthly_india_3d_arrays,  # Placeholder for the monthly 3D data dictionary
-        month,
-        missing_index,
-        sequence_length
+        missing_indices,
+        sequence_length,
+        report_memory=True,
+        return_index=True
     )
-    all_sequences.append(sequences)
-    all_targets.append(targets)
-
-# Concatenate all sequences and targets
-all_sequences = np.concatenate(all_sequences, axis=0)
-all_targets = np.concatenate(all_targets, axis=0)
-
-# Normalize the data (optional, uncomment if needed)
-# all_sequences = (all_sequences - np.nanmin(all_sequences)) / (np.nanmax(all_sequences) - np.nanmin(all_sequences))
-# all_targets = (all_targets - np.nanmin(all_targets)) / (np.nanmax(all_targets) - np.nanmin(all_targets))
-
-# Split into training and testing sets
-X_train, X_test, y_train, y_test = train_test_split(
-    all_sequences, all_targets, test_size=0.2, random_state=42
-)
-
-# Reshape data for LSTM input (LSTM expects input of shape [samples, time steps, features])
-X_train = X_train[..., np.newaxis]  # Adding a feature axis
-X_test = X_test[..., np.newaxis]
-
-# Output the shapes for verification
-print(f"X_train shape: {X_train.shape}")
-print(f"X_test shape: {X_test.shape}")
-print(f"y_train shape: {y_train.shape}")
-print(f"y_test shape: {y_test.shape}")
+
+    # Normalize the data (optional, uncomment if needed)
+    # all_sequences = (all_sequences - np.nanmin(all_sequences)) / (np.nanmax(all_sequences) - np.nanmin(all_sequences))
+    # all_targets = (all_targets - np.nanmin(all_targets)) / (np.nanmax(all_targets) - np.nanmin(all_targets))
+
+    # Split into training and testing sets
+    X_train, X_test, y_train, y_test, cells_train, cells_test, months_train, months_test = train_test_split(
+        all_sequences, all_targets, all_cells, all_months, test_size=0.2, random_state=42
+    )
+
+    # Reshape data for LSTM input (LSTM expects input of shape [samples, time steps, features])
+    X_train = X_train[..., np.newaxis]  # Adding a feature axis
+    X_test = X_test[..., np.newaxis]
+
+    # Output the shapes for verification
+    print(f"X_train shape: {X_train.shape}")
+    print(f"X_test shape: {X_test.shape}")
+    print(f"y_train shape: {y_train.shape}")
+    print(f"y_test shape: {y_test.shape}")
@@ -0,0 +1,98 @@
+import numpy as np
+
+from cube_layout import build_valid_cell_index
+from incremental_update import (
+    _gaps_to_reinfer,
+    _merge_overlay,
+    _refresh_id,
+    _save_sequence_part,
+    build_new_windows,
+    load_sequences,
+    open_sequence_parts,
+)
+
+
+def window_rows(windows):
+    """Rows of (cell, month, target, sequence...) in a fixed order, for comparing window sets."""
+    rows = np.column_stack([windows["cells"], windows["months"], windows["targets"], windows["sequences"]])
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def test_new_windows_complete_the_old_set():
+    sequence_length = 3
+    rng = np.random.default_rng(0)
+    cube = {month: rng.normal(size=(4, 5, 10)).astype(np.float32) for month in range(1, 13)}
+    for array in cube.values():
+        array[0, :2] = np.nan  # cells without data
+    cube[3][:, :, 4] = np.nan  # a gap
+    gaps = {month: np.array([4] if month == 3 else [], dtype=np.int64) for month in cube}
+    valid_cells = build_valid_cell_index(cube)
+
+    # The last year, and year 8 from July on, are published by the refresh
+    changed = {month: ([8, 9] if month >= 7 else [9]) for month in cube}
+    old_cube = {month: np.copy(array) for month, array in cube.items()}
+    for month, indices in changed.items():
+        old_cube[month][:, :, indices] = np.nan
+
+    everything = {month: np.arange(10) for month in cube}
+    old = build_new_windows(old_cube, gaps, everything, sequence_length, valid_cells)
+    new = build_new_windows(cube, gaps, changed, sequence_length, valid_cells)
+    full = build_new_windows(cube, gaps, everything, sequence_length, valid_cells)
+
+    assert len(new["targets"]) > 0
+    combined = {name: np.concatenate([old[name], new[name]]) for name in full}
+    np.testing.assert_array_equal(window_rows(combined), window_rows(full))
+
+
+def test_gaps_to_reinfer():
+    gaps = {1: np.array([14, 15]), 2: np.array([3]), 5: np.array([10, 17])}
+    previous_gaps = {"1": [14, 15], "2": [3], "5": [10]}
+
+    selected = _gaps_to_reinfer(gaps, previous_gaps, {1: [12], 5: [2]}, sequence_length=6)
+
+    # Month 1: 14 reads the changed index 12, and 15 reads the re-predicted 14.
+    # Month 2 is unchanged; month 5 gets only its new gap.
+    assert selected == {1: [14, 15], 5: [17]}
+
+
+def test_gaps_to_reinfer_follows_chains_only_within_the_window():
+    gaps = {1: np.array([4, 15])}
+
+    assert _gaps_to_reinfer(gaps, {"1": [4, 15]}, {1: [2]}, sequence_length=6) == {1: [4]}
+
+
+def test_merge_overlay():
+    overlay = {
+        1: (np.array([14, 14, 15]), np.array([0, 1, 0]), np.array([1.0, 2.0, 3.0])),
+        2: (np.array([3]), np.array([7]), np.array([4.0])),
+        4: (np.array([9]), np.array([2]), np.array([5.0])),
+    }
+    update = {1: (np.array([15]), np.array([0]), np.array([6.0]))}
+    # 14 of month 1 and the gap of month 4 were published in the meantime
+    gaps = {1: np.array([15]), 2: np.array([3]), 4: np.array([], dtype=np.int64)}
+
+    merged = _merge_overlay(overlay, update, gaps)
+
+    assert sorted(merged) == [1, 2]
+    for expected, actual in zip(update[1], merged[1]):
+        np.testing.assert_array_equal(actual, expected)
+    for expected, actual in zip(overlay[2], merged[2]):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_rerun_refresh_does_not_duplicate_its_part(tmp_path):
+    rng = np.random.default_rng(0)
+    parts = [
+        {"sequences": rng.normal(size=(n, 3)), "targets": rng.normal(size=n),
+         "cells": np.arange(n), "months": np.full(n, 1, dtype=np.int8)}
+        for n in (5, 4)
+    ]
+    _save_sequence_part(tmp_path, parts[0], _refresh_id(["a.tif"]))
+    _save_sequence_part(tmp_path, parts[1], _refresh_id(["b.tif"]))
+    _save_sequence_part(tmp_path, parts[1], _refresh_id(["b.tif"]))
+
+    assert [len(part["targets"]) for part in open_sequence_parts(tmp_path)] == [5, 4]
+    rows = np.array([7, 0, 4, 8])
+    sequences, targets, _, _ = load_sequences(tmp_path, rows)
+    all_targets = np.concatenate([part["targets"] for part in parts])
+    np.testing.assert_array_equal(targets, all_targets[rows])
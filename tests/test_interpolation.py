@@ -0,0 +1,102 @@
+import numpy as np
+
+from calculate_missing_indices_of_monthly_arrays import calculate_missing_indices
+from interpolation_using_trained_model import (
+    gather_missing_windows,
+    interpolate_missing_data_with_lstm_batched,
+    predict_missing_values,
+)
+
+
+class WindowMeanModel:
+    """Predicts the mean of each input window; records every batch it sees."""
+
+    def __init__(self):
+        self.batches = []
+
+    def predict_on_batch(self, inputs):
+        self.batches.append(np.array(inputs))
+        return inputs.mean(axis=1)
+
+
+def make_monthly_data(shape=(3, 4), years=18, gaps=None, seed=0):
+    rng = np.random.default_rng(seed)
+    monthly_data = {month: rng.normal(size=shape + (years,)).astype(np.float32) for month in range(1, 13)}
+    for month, indices in (gaps or {}).items():
+        monthly_data[month][:, :, indices] = np.nan
+    return monthly_data
+
+
+def fill_one_gap_at_a_time(monthly_data, gaps, sequence_length):
+    """Reference: fill each gap in time order, writing it back before building the next window."""
+    filled = {month: np.copy(monthly_data[month]) for month in gaps}
+    model = WindowMeanModel()
+    for month, indices in gaps.items():
+        for index in sorted(indices):
+            filled = {
+                **filled,
+                **interpolate_missing_data_with_lstm_batched(model, filled, {month: [index]}, sequence_length),
+            }
+    return filled
+
+
+def test_consecutive_gaps_read_the_earlier_fill():
+    gaps = {1: [14, 15]}
+    monthly_data = make_monthly_data(gaps=gaps)
+    model = WindowMeanModel()
+
+    interpolated = interpolate_missing_data_with_lstm_batched(model, monthly_data, gaps, sequence_length=6)
+
+    assert all(not np.any(batch == -9999.0) for batch in model.batches)
+    expected = fill_one_gap_at_a_time(monthly_data, gaps, sequence_length=6)
+    np.testing.assert_allclose(interpolated[1], expected[1], rtol=1e-6)
+    assert np.all(np.isfinite(interpolated[1]))
+
+
+def test_gaps_filled_out_of_order_and_across_months():
+    gaps = {1: [15, 14], 2: [3], 7: [10, 11, 12]}
+    monthly_data = make_monthly_data(gaps=gaps)
+
+    interpolated = interpolate_missing_data_with_lstm_batched(WindowMeanModel(), monthly_data, gaps, 4)
+
+    expected = fill_one_gap_at_a_time(monthly_data, gaps, sequence_length=4)
+    for month in gaps:
+        np.testing.assert_allclose(interpolated[month], expected[month], rtol=1e-6)
+
+
+def test_prior_overlay_feeds_later_gaps():
+    monthly_data = make_monthly_data(gaps={1: [14, 15]})
+    first = predict_missing_values(WindowMeanModel(), monthly_data, {1: [14]}, 6)
+    second = predict_missing_values(WindowMeanModel(), monthly_data, {1: [15]}, 6, prior_overlay=first)
+
+    both = predict_missing_values(WindowMeanModel(), monthly_data, {1: [14, 15]}, 6)
+    later = both[1][0] == 15
+    np.testing.assert_allclose(second[1][2], both[1][2][later], rtol=1e-6)
+    assert np.all(second[1][0] == 15)
+
+
+def test_windows_without_overlay_keep_placeholder():
+    monthly_data = make_monthly_data(gaps={1: [14, 15]})
+    windows, locations = gather_missing_windows(monthly_data, {1: [15]}, 6)
+
+    assert np.all(windows[:, -1, 0] == -9999.0)
+    assert [(month, index) for month, index, _ in locations] == [(1, 15)]
+
+
+def test_calculate_missing_indices_returns_lists():
+    missing_indices = calculate_missing_indices(2003, 2021, {1: 2018, 7: [2017, 2018]})
+
+    assert missing_indices == {1: [15], 7: [14, 15]}
+
+
+def test_fortran_ordered_input_is_filled():
+    gaps = {1: [15]}
+    monthly_data = make_monthly_data(shape=(4, 5), years=19, gaps=gaps)
+    monthly_data[1] = np.asfortranarray(monthly_data[1])
+
+    interpolated = interpolate_missing_data_with_lstm_batched(WindowMeanModel(), monthly_data, gaps, 6)
+    in_place = interpolate_missing_data_with_lstm_batched(WindowMeanModel(), monthly_data, gaps, 6, in_place=True)
+
+    assert np.all(np.isfinite(interpolated[1]))
+    assert np.all(np.isfinite(in_place[1]))
+    np.testing.assert_allclose(in_place[1], interpolated[1], rtol=1e-6)
@@ -0,0 +1,30 @@
+from calculate_missing_indices_of_monthly_arrays import (
+    build_availability_matrix,
+    mark_unpublished_months_available,
+    missing_indices_from_availability,
+)
+
+
+def tiff_names(start, stop):
+    """Names of the monthly files from (year, month) `start` up to and including `stop`."""
+    names = []
+    year, month = start
+    while (year, month) <= stop:
+        names.append(f"TWSA_{year}{month:02d}_mascon.tif")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return names
+
+
+def test_unpublished_months_are_not_gaps():
+    files = [name for name in tiff_names((2003, 1), (2021, 6)) if not name.startswith("TWSA_201803")]
+    availability = build_availability_matrix(files, 2003, 2021)
+
+    assert missing_indices_from_availability(availability)[7] == [18]
+    missing_indices = missing_indices_from_availability(mark_unpublished_months_available(availability))
+    assert missing_indices == {3: [15]}
+
+
+def test_nothing_published_has_no_gaps():
+    availability = build_availability_matrix([], 2003, 2005)
+
+    assert missing_indices_from_availability(mark_unpublished_months_available(availability)) == {}
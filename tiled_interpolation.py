@@ -0,0 +1,262 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from interpolation_using_trained_model import apply_overlay, load_overlay, predict_missing_values, save_overlay
+
+# Model loaded once per worker process by `_init_worker`
+_worker_model = None
+
+
+def load_inference_model(model_path, threads=None):
+    """
+    Loads a trained model for inference, optionally pinning TensorFlow's thread pools.
+
+    Weights exported with `numpy_lstm.export_lstm_weights` (.npz) are loaded into the
+    NumPy backend, which does not import TensorFlow at all.
+
+    Parameters:
+    model_path (str): Path of a model saved with `model.save`, or of exported .npz weights.
+    threads (int, optional): Number of intra- and inter-op threads TensorFlow may use.
+
+    Returns:
+    tf.keras.Model or NumpyLSTMModel: The loaded model.
+    """
+    if threads is not None:
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+
+    if model_path.endswith(".npz"):
+        from numpy_lstm import NumpyLSTMModel
+
+        return NumpyLSTMModel.load(model_path)
+
+    import tensorflow as tf
+
+    if threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    return tf.keras.models.load_model(model_path, compile=False)
+
+
+def _init_worker(model_path, threads):
+    global _worker_model
+    _worker_model = load_inference_model(model_path, threads)
+
+
+def split_into_tiles(grid_shape, tile_size):
+    """
+    Splits an (x, y) grid into rectangular tiles.
+
+    Parameters:
+    grid_shape (tuple): (n_x, n_y) shape of the grid.
+    tile_size (tuple): (tile_x, tile_y) size of each tile; edge tiles may be smaller.
+
+    Returns:
+    list: (x_start, x_stop, y_start, y_stop) bounds of every tile.
+    """
+    return [
+        (x, min(x + tile_size[0], grid_shape[0]), y, min(y + tile_size[1], grid_shape[1]))
+        for x in range(0, grid_shape[0], tile_size[0])
+        for y in range(0, grid_shape[1], tile_size[1])
+    ]
+
+
+def _tile_checkpoint_path(checkpoint_directory, tile):
+    return os.path.join(checkpoint_directory, f"tile_{tile[0]:05d}_{tile[2]:05d}.npz")
+
+
+def _model_fingerprint(model_path):
+    """Hashes the bytes of a saved model (a file, or every file of a SavedModel directory)."""
+    digest = hashlib.sha256()
+    if os.path.isdir(model_path):
+        paths = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(model_path) for name in names
+        )
+    else:
+        paths = [model_path]
+    for path in paths:
+        digest.update(os.path.relpath(path, model_path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _data_fingerprint(monthly_data, months, chunk_size=1_000_000):
+    """Hashes the dtype, shape and values of the monthly arrays of `months`, a block of rows at a time."""
+    digest = hashlib.sha256()
+    for month in sorted(months):
+        array = monthly_data[month]
+        digest.update(f"{month}:{array.dtype.str}{array.shape}".encode())
+        rows_per_chunk = max(1, chunk_size // max(1, array.shape[1]))
+        for start in range(0, array.shape[0], rows_per_chunk):
+            digest.update(np.ascontiguousarray(array[start:start + rows_per_chunk]).tobytes())
+    return digest.hexdigest()
+
+
+def _write_tile_checkpoint(checkpoint_path, overlay):
+    """Saves a tile overlay to a temporary file and renames it, so a checkpoint is never partial."""
+    temp_path = f"{checkpoint_path}.tmp.npz"
+    save_overlay(temp_path, overlay)
+    os.replace(temp_path, checkpoint_path)
+
+
+def _tile_valid_cells(rows, cols, tile):
+    """Converts the (row, col) positions of the valid cells to flat indices local to `tile`."""
+    inside = (rows >= tile[0]) & (rows < tile[1]) & (cols >= tile[2]) & (cols < tile[3])
+    return (rows[inside] - tile[0]) * (tile[3] - tile[2]) + (cols[inside] - tile[2])
+
+
+def _interpolate_tile(tile, tile_data, missing_indices, sequence_length, batch_size, tile_valid_cells,
+                      grid_shape, checkpoint_path):
+    """Fills the gaps of one tile in a worker process and checkpoints the result to disk."""
+    start = time.perf_counter()
+    overlay = predict_missing_values(
+        _worker_model, tile_data, missing_indices, sequence_length, batch_size, tile_valid_cells
+    )
+
+    # Store global flat cell indices so checkpoints can be merged without knowing the tile
+    checkpoint = {}
+    n_cells = 0
+    for month, (time_indices, cells, values) in overlay.items():
+        rows, cols = np.divmod(cells, tile[3] - tile[2])
+        checkpoint[month] = (time_indices, (rows + tile[0]) * grid_shape[1] + (cols + tile[2]), values)
+        n_cells += cells.size
+
+    _write_tile_checkpoint(checkpoint_path, checkpoint)
+    return n_cells, time.perf_counter() - start
+
+
+def load_tile_checkpoint(checkpoint_path):
+    """
+    Reads a tile checkpoint back into a sparse overlay.
+
+    Returns:
+    dict: Overlay with months as keys and (time_indices, cells, values) as values,
+        using global flat cell indices (see `interpolation_using_trained_model.apply_overlay`).
+    """
+    return load_overlay(checkpoint_path)
+
+
+def interpolate_tiled(model_path, monthly_data, missing_indices, sequence_length, checkpoint_directory,
+                      tile_size=(64, 64), max_workers=None, threads_per_worker=1, batch_size=65536,
+                      valid_cells=None, in_place=False):
+    """
+    Fills the gaps tile by tile across a process pool, checkpointing every finished tile.
+
+    Each worker loads its own copy of the model with `threads_per_worker` threads, so
+    throughput scales with the number of cores. Tiles are cut from `monthly_data`
+    only when a worker is free, with at most two per worker in flight, so the
+    pending tiles are never all copied at once. Finished tiles are written to
+    `checkpoint_directory`; rerunning with the same model, data and arguments skips them,
+    so an interrupted run resumes where it stopped.
+
+    Parameters:
+    model_path (str): Path of a model saved with `model.save`, or of exported .npz weights.
+    monthly_data (dict): Dictionary with months as keys and corresponding 3D numpy arrays as values.
+    missing_indices (dict): Dictionary with months as keys and the missing index (year), or a
+        list of missing indices, as values.
+    sequence_length (int): Length of the input sequences for LSTM.
+    checkpoint_directory (str): Directory holding one checkpoint file per finished tile.
+    tile_size (tuple): (tile_x, tile_y) size of each tile.
+    max_workers (int, optional): Number of worker processes (default: number of CPUs).
+    threads_per_worker (int): TensorFlow threads per worker.
+    batch_size (int): Number of cells sent to the model per call.
+    valid_cells (np.ndarray, optional): Global flat indices of the cells to fill.
+    in_place (bool): Write the predictions into `monthly_data` instead of copies.
+
+    Returns:
+    dict: Dictionary containing interpolated data for each month.
+    """
+    grid_shape = next(iter(monthly_data.values())).shape[:2]
+    os.makedirs(checkpoint_directory, exist_ok=True)
+
+    # Refuse to resume from checkpoints written for a different run
+    manifest = {
+        "model": _model_fingerprint(model_path),
+        "data": _data_fingerprint(monthly_data, missing_indices),
+        "valid_cells": (
+            None if valid_cells is None
+            else hashlib.sha256(np.ascontiguousarray(valid_cells, dtype=np.int64).tobytes()).hexdigest()
+        ),
+        "grid_shape": list(grid_shape),
+        "tile_size": list(tile_size),
+        "sequence_length": sequence_length,
+        "missing_indices": {
+            str(month): np.atleast_1d(indices).tolist() for month, indices in missing_indices.items()
+        },
+    }
+    manifest_path = os.path.join(checkpoint_directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) != manifest:
+                raise ValueError(
+                    f"Checkpoints in {checkpoint_directory} belong to a different run; use a new directory."
+                )
+    else:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    tiles = split_into_tiles(grid_shape, tile_size)
+    pending = [tile for tile in tiles if not os.path.exists(_tile_checkpoint_path(checkpoint_directory, tile))]
+    print(f"Tiles: {len(tiles)} total, {len(tiles) - len(pending)} already done, {len(pending)} to run.")
+
+    if pending:
+        start = time.perf_counter()
+        cells_done = 0
+        context = multiprocessing.get_context("spawn")
+        if valid_cells is not None:
+            valid_rows, valid_cols = np.divmod(valid_cells, grid_shape[1])
+        max_workers = max_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(model_path, threads_per_worker)) as executor:
+            in_flight = set()
+            completed = 0
+            remaining = iter(pending)
+            while True:
+                # Top up the queue; a tile's data is only copied when it is submitted
+                for tile in remaining:
+                    tile_valid_cells = None
+                    if valid_cells is not None:
+                        tile_valid_cells = _tile_valid_cells(valid_rows, valid_cols, tile)
+                        if tile_valid_cells.size == 0:
+                            # Nothing to fill; write an empty checkpoint so the tile counts as done
+                            _write_tile_checkpoint(_tile_checkpoint_path(checkpoint_directory, tile), {})
+                            completed += 1
+                            continue
+
+                    tile_data = {
+                        month: np.ascontiguousarray(monthly_data[month][tile[0]:tile[1], tile[2]:tile[3]])
+                        for month in missing_indices
+                    }
+                    in_flight.add(executor.submit(
+                        _interpolate_tile, tile, tile_data, missing_indices, sequence_length, batch_size,
+                        tile_valid_cells, grid_shape, _tile_checkpoint_path(checkpoint_directory, tile)
+                    ))
+                    if len(in_flight) >= 2 * max_workers:
+                        break
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    n_cells, _ = future.result()
+                    cells_done += n_cells
+                    completed += 1
+                elapsed = time.perf_counter() - start
+                print(f"Progress: {completed}/{len(pending)} tiles, {cells_done} cells, "
+                      f"{cells_done / elapsed:.0f} cells/sec")
+
+    if in_place:
+        interpolated_data = {month: monthly_data[month] for month in missing_indices}
+    else:
+        interpolated_data = {month: np.copy(monthly_data[month], order="C") for month in missing_indices}
+    for tile in tiles:
+        apply_overlay(interpolated_data, load_tile_checkpoint(_tile_checkpoint_path(checkpoint_directory, tile)))
+
+    return interpolated_data
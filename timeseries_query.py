@@ -0,0 +1,434 @@
+"""
+Point and region time-series queries over the gap-filled cube.
+
+`build_query_store` rewrites the filled monthly arrays once into a store laid out
+for reads: one float32 row per valid grid cell holding its full monthly series in
+calendar order, with rows grouped by square spatial tiles. `TimeSeriesStore`
+memory-maps that store, maps lat/lon to a cell with the inverse affine transform,
+keeps recently used tiles in an LRU cache, and averages regions through a
+precomputed cell-to-region index, so a query reads only the tiles it touches.
+
+Usage:
+    python timeseries_query.py build --store store --state state
+    python timeseries_query.py regions --store store --shapefile basins.shp --id-column name
+    python timeseries_query.py point --store store --lat 23.5 --lon 80.25
+    python timeseries_query.py region --store store --id Ganga
+    python timeseries_query.py serve --store store --port 8080
+"""
+import argparse
+import json
+import os
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from cube_layout import as_cell_time_matrix, build_valid_cell_index
+
+
+def build_query_store(store_directory, monthly_data, start_year, transform, crs=None, tile_size=32,
+                      cells_per_block=65536):
+    """
+    Writes the filled monthly arrays as a tile-ordered (cell, month) store.
+
+    Parameters:
+    ----------
+    store_directory : str
+        Destination directory.
+    monthly_data : dict
+        A dictionary where keys are months (1-12) and values are gap-filled 3D arrays (x, y, year).
+    start_year : int
+        Year of time index 0.
+    transform : affine.Affine or sequence
+        Affine transform (a, b, c, d, e, f) of the grid, mapping (col, row) to (lon, lat).
+    crs : str, optional
+        CRS of the grid, stored for reference.
+    tile_size : int, optional
+        Side of the square tiles that rows are grouped by; one tile is one cache entry.
+    cells_per_block : int, optional
+        Number of cells copied at a time while building the store.
+    """
+    os.makedirs(store_directory, exist_ok=True)
+    grid_shape = next(iter(monthly_data.values())).shape[:2]
+    n_years = next(iter(monthly_data.values())).shape[2]
+
+    # Order the valid cells tile by tile so each tile is one contiguous run of rows
+    valid_cells = build_valid_cell_index(monthly_data)
+    rows, cols = np.divmod(valid_cells, grid_shape[1])
+    tiles_per_row = -(-grid_shape[1] // tile_size)
+    tile_ids = (rows // tile_size) * tiles_per_row + cols // tile_size
+    order = np.lexsort((valid_cells, tile_ids))
+    valid_cells, tile_ids = valid_cells[order], tile_ids[order]
+
+    n_tiles = -(-grid_shape[0] // tile_size) * tiles_per_row
+    tile_offsets = np.searchsorted(tile_ids, np.arange(n_tiles + 1)).astype(np.int64)
+    row_of_cell = np.full(grid_shape[0] * grid_shape[1], -1, dtype=np.int32)
+    row_of_cell[valid_cells] = np.arange(len(valid_cells), dtype=np.int32)
+
+    series = np.lib.format.open_memmap(
+        os.path.join(store_directory, "series.npy"), mode="w+", dtype=np.float32,
+        shape=(len(valid_cells), n_years * 12)
+    )
+    matrices = {month: as_cell_time_matrix(array) for month, array in monthly_data.items()}
+    for start in range(0, len(valid_cells), cells_per_block):
+        block_cells = valid_cells[start:start + cells_per_block]
+        block = np.full((len(block_cells), n_years * 12), np.nan, dtype=np.float32)
+        for month, matrix in matrices.items():
+            block[:, month - 1::12] = matrix[block_cells]
+        series[start:start + len(block_cells)] = block
+    series.flush()
+    del series
+
+    np.savez(os.path.join(store_directory, "index.npz"), row_of_cell=row_of_cell, tile_offsets=tile_offsets)
+    with open(os.path.join(store_directory, "metadata.json"), "w") as f:
+        json.dump({
+            "start_year": start_year,
+            "n_months": n_years * 12,
+            "grid_shape": list(grid_shape),
+            "transform": [float(value) for value in tuple(transform)[:6]],
+            "crs": str(crs) if crs is not None else None,
+            "tile_size": tile_size,
+        }, f, indent=2)
+    print(f"Built query store with {len(valid_cells)} cells and {n_years * 12} months: {store_directory}")
+
+
+def save_region_index(store_directory, region_grid, region_names):
+    """
+    Saves a cell-to-region index from a label grid.
+
+    Parameters:
+    ----------
+    store_directory : str
+        Directory of the query store.
+    region_grid : np.ndarray
+        (x, y) grid of region numbers, 1-based, with 0 outside every region.
+    region_names : list
+        Name of region 1, 2, ...
+    """
+    labels = region_grid.ravel()
+    cells = np.flatnonzero(labels).astype(np.int64)
+    cells = cells[np.argsort(labels[cells], kind="stable")]
+    offsets = np.searchsorted(labels[cells], np.arange(1, len(region_names) + 2)).astype(np.int64)
+    np.savez(os.path.join(store_directory, "regions.npz"), cells=cells, offsets=offsets,
+             names=np.array([str(name) for name in region_names]))
+
+
+def build_region_index(store_directory, regions, id_column):
+    """
+    Rasterizes polygons (e.g. basins) onto the store grid and saves the cell-to-region index.
+
+    A cell belongs to the region that contains its center.
+
+    Parameters:
+    ----------
+    store_directory : str
+        Directory of the query store.
+    regions : geopandas.GeoDataFrame
+        Region polygons; reprojected to the store CRS when it is known.
+    id_column : str
+        Column holding the region names.
+    """
+    from affine import Affine
+    from rasterio.features import rasterize
+
+    with open(os.path.join(store_directory, "metadata.json")) as f:
+        metadata = json.load(f)
+    if metadata["crs"]:
+        regions = regions.to_crs(metadata["crs"])
+
+    region_grid = rasterize(
+        ((geometry, number) for number, geometry in enumerate(regions.geometry, start=1)),
+        out_shape=tuple(metadata["grid_shape"]), transform=Affine(*metadata["transform"]), fill=0, dtype="int32"
+    )
+    save_region_index(store_directory, region_grid, regions[id_column].tolist())
+    print(f"Indexed {len(regions)} regions: {store_directory}")
+
+
+class TimeSeriesStore:
+    """
+    Read-only query interface over a store written by `build_query_store`.
+
+    Parameters:
+    ----------
+    store_directory : str
+        Directory of the query store.
+    cache_tiles : int, optional
+        Number of spatial tiles kept in memory by the LRU cache.
+    """
+
+    def __init__(self, store_directory, cache_tiles=256):
+        with open(os.path.join(store_directory, "metadata.json")) as f:
+            self.metadata = json.load(f)
+        self.series = np.load(os.path.join(store_directory, "series.npy"), mmap_mode="r")
+        with np.load(os.path.join(store_directory, "index.npz")) as index:
+            self.row_of_cell = index["row_of_cell"]
+            self.tile_offsets = index["tile_offsets"]
+
+        self.grid_shape = tuple(self.metadata["grid_shape"])
+        self.tile_size = self.metadata["tile_size"]
+        self.tiles_per_row = -(-self.grid_shape[1] // self.tile_size)
+        self.dates = np.arange(
+            np.datetime64(f"{self.metadata['start_year']}-01", "M"),
+            np.datetime64(f"{self.metadata['start_year']}-01", "M") + self.metadata["n_months"]
+        )
+
+        # Inverse of the (col, row) -> (x, y) affine transform
+        a, b, c, d, e, f = self.metadata["transform"]
+        self._inverse = np.linalg.inv(np.array([[a, b], [d, e]]))
+        self._origin = np.array([c, f])
+
+        self.regions = None
+        regions_path = os.path.join(store_directory, "regions.npz")
+        if os.path.exists(regions_path):
+            with np.load(regions_path) as regions:
+                self.region_cells = regions["cells"]
+                self.region_offsets = regions["offsets"]
+                self.regions = {str(name): number for number, name in enumerate(regions["names"])}
+
+        self._tile = lru_cache(maxsize=cache_tiles)(self._read_tile)
+
+    def _read_tile(self, tile_id):
+        return np.array(self.series[self.tile_offsets[tile_id]:self.tile_offsets[tile_id + 1]])
+
+    def _tile_of(self, rows, cols):
+        return (rows // self.tile_size) * self.tiles_per_row + cols // self.tile_size
+
+    def cache_info(self):
+        """Hit and miss counts of the tile cache."""
+        return self._tile.cache_info()
+
+    def cell_of(self, lat, lon):
+        """
+        Returns the (row, col) of the grid cell containing a point.
+
+        Raises:
+        ------
+        ValueError
+            If the point is outside the grid.
+        """
+        col, row = np.floor(self._inverse @ (np.array([lon, lat]) - self._origin)).astype(int)
+        if not (0 <= row < self.grid_shape[0] and 0 <= col < self.grid_shape[1]):
+            raise ValueError(f"Point ({lat}, {lon}) is outside the grid.")
+        return int(row), int(col)
+
+    def point_series(self, lat, lon):
+        """
+        Returns the monthly series of the cell containing (lat, lon).
+
+        Returns:
+        -------
+        np.ndarray
+            float32 array aligned with `self.dates`; all NaN for cells without data. It is a
+            copy, so modifying it does not change the cached tile.
+        """
+        row, col = self.cell_of(lat, lon)
+        store_row = self.row_of_cell[row * self.grid_shape[1] + col]
+        if store_row < 0:
+            return np.full(len(self.dates), np.nan, dtype=np.float32)
+        tile_id = self._tile_of(row, col)
+        return self._tile(tile_id)[store_row - self.tile_offsets[tile_id]].copy()
+
+    def region_series(self, region, area_weighted=True):
+        """
+        Returns the mean monthly series over a region of the region index.
+
+        Parameters:
+        ----------
+        region : str
+            Region name.
+        area_weighted : bool, optional
+            Weight cells by the cosine of their latitude, for geographic grids.
+
+        Returns:
+        -------
+        np.ndarray
+            float64 array aligned with `self.dates`.
+        """
+        if self.regions is None:
+            raise ValueError("The store has no region index; run build_region_index first.")
+        if region not in self.regions:
+            raise KeyError(f"Unknown region '{region}'.")
+        number = self.regions[region]
+        cells = self.region_cells[self.region_offsets[number]:self.region_offsets[number + 1]]
+        store_rows = self.row_of_cell[cells]
+        cells, store_rows = cells[store_rows >= 0], store_rows[store_rows >= 0]
+        if cells.size == 0:
+            return np.full(len(self.dates), np.nan)
+
+        rows, cols = np.divmod(cells, self.grid_shape[1])
+        tile_ids = self._tile_of(rows, cols)
+        values = np.empty((cells.size, len(self.dates)), dtype=np.float32)
+        for tile_id in np.unique(tile_ids):
+            in_tile = tile_ids == tile_id
+            values[in_tile] = self._tile(int(tile_id))[store_rows[in_tile] - self.tile_offsets[tile_id]]
+
+        if area_weighted:
+            a, b, c, d, e, f = self.metadata["transform"]
+            latitudes = d * (cols + 0.5) + e * (rows + 0.5) + f
+            weights = np.cos(np.radians(latitudes))
+        else:
+            weights = np.ones(cells.size)
+        finite = np.isfinite(values)
+        total_weight = (weights[:, np.newaxis] * finite).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (weights[:, np.newaxis] * np.where(finite, values, 0)).sum(axis=0) / total_weight
+
+    def as_json(self, values):
+        """Pairs a series with the store dates as JSON-ready [{"date", "twsa"}] records."""
+        return [
+            {"date": str(date), "twsa": None if np.isnan(value) else round(float(value), 4)}
+            for date, value in zip(self.dates, values)
+        ]
+
+
+def _query_parameter(params, name):
+    if name not in params:
+        raise ValueError(f"Missing query parameter '{name}'.")
+    return params[name]
+
+
+def _make_handler(store):
+    class QueryHandler(BaseHTTPRequestHandler):
+        """Serves GET /point?lat=&lon=, /region?id= and /regions as JSON."""
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == "/point":
+                    lat, lon = float(_query_parameter(params, "lat")), float(_query_parameter(params, "lon"))
+                    body = {"lat": lat, "lon": lon, "cell": store.cell_of(lat, lon),
+                            "series": store.as_json(store.point_series(lat, lon))}
+                elif url.path == "/region":
+                    region = _query_parameter(params, "id")
+                    body = {"region": region, "series": store.as_json(store.region_series(region))}
+                elif url.path == "/regions":
+                    body = {"regions": sorted(store.regions or {})}
+                else:
+                    self._send(404, {"error": f"Unknown path {url.path}"})
+                    return
+            except KeyError as e:
+                self._send(404, {"error": e.args[0]})
+                return
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+                return
+            self._send(200, body)
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+def serve(store_directory, host="127.0.0.1", port=8080, cache_tiles=256):
+    """Serves the store over HTTP until interrupted."""
+    store = TimeSeriesStore(store_directory, cache_tiles)
+    server = ThreadingHTTPServer((host, port), _make_handler(store))
+    print(f"Serving {store_directory} on http://{host}:{port} (/point?lat=&lon=, /region?id=, /regions)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _load_filled_cube(args):
+    """Returns (monthly_data, start_year, tiff_directory, shapefile) for the build command."""
+    if args.state:
+        from incremental_update import _read_state, load_interpolated_monthly_arrays
+
+        state = _read_state(args.state)
+        monthly_data, _ = load_interpolated_monthly_arrays(args.state)
+        return monthly_data, state["start_year"], state["tiff_directory"], state["shapefile"]
+
+    from monthly_array_cache import open_monthly_arrays
+
+    # Pipeline outputs: the ingested cube, with the months that had gaps replaced by their filled arrays
+    monthly_data = dict(open_monthly_arrays(args.cube))
+    if args.interpolated:
+        monthly_data.update(open_monthly_arrays(args.interpolated))
+    with open(os.path.join(args.cube, "metadata.json")) as f:
+        start_year = json.load(f)["start_year"]
+    return monthly_data, start_year, args.tiff_directory, args.shapefile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the store from a filled cube.")
+    build_parser.add_argument("--store", required=True)
+    build_parser.add_argument("--state", help="Incremental-update state directory.")
+    build_parser.add_argument("--cube", help="Monthly array cache directory (pipeline ingest stage).")
+    build_parser.add_argument("--interpolated", help="Filled months (pipeline interpolate stage).")
+    build_parser.add_argument("--tiff-directory", help="TIFFs the cube was ingested from (not needed with --state).")
+    build_parser.add_argument("--shapefile", help="Mask the cube was ingested with (not needed with --state).")
+    build_parser.add_argument("--tile-size", type=int, default=32)
+
+    regions_parser = subparsers.add_parser("regions", help="Index polygon regions for aggregation.")
+    regions_parser.add_argument("--store", required=True)
+    regions_parser.add_argument("--shapefile", required=True)
+    regions_parser.add_argument("--id-column", required=True)
+
+    point_parser = subparsers.add_parser("point", help="Print the series of a lat/lon point.")
+    point_parser.add_argument("--store", required=True)
+    point_parser.add_argument("--lat", type=float, required=True)
+    point_parser.add_argument("--lon", type=float, required=True)
+
+    region_parser = subparsers.add_parser("region", help="Print the mean series of a region.")
+    region_parser.add_argument("--store", required=True)
+    region_parser.add_argument("--id", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve queries over HTTP.")
+    serve_parser.add_argument("--store", required=True)
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--cache-tiles", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        import geopandas as gpd
+        import rasterio
+        from rasterio.windows import transform as window_transform
+
+        from create_monthly_arrays import prepare_mask_window
+
+        if not args.state and not args.cube:
+            parser.error("build needs --state or --cube")
+        monthly_data, start_year, tiff_directory, shapefile = _load_filled_cube(args)
+        if not tiff_directory or not shapefile:
+            parser.error("build from --cube needs --tiff-directory and --shapefile")
+
+        # The cube covers the window of the mask, so its transform is the window's
+        tiff_files = sorted(f for f in os.listdir(tiff_directory) if f.endswith(".tif"))
+        window, _, _ = prepare_mask_window(tiff_files, tiff_directory, gpd.read_file(shapefile))
+        with rasterio.open(os.path.join(tiff_directory, tiff_files[0])) as src:
+            transform, crs = window_transform(window, src.transform), src.crs
+        build_query_store(args.store, monthly_data, start_year, transform, crs, tile_size=args.tile_size)
+    elif args.command == "regions":
+        import geopandas as gpd
+
+        build_region_index(args.store, gpd.read_file(args.shapefile), args.id_column)
+    elif args.command == "point":
+        store = TimeSeriesStore(args.store)
+        print(json.dumps(store.as_json(store.point_series(args.lat, args.lon)), indent=2))
+    elif args.command == "region":
+        store = TimeSeriesStore(args.store)
+        print(json.dumps(store.as_json(store.region_series(args.id)), indent=2))
+    else:
+        serve(args.store, args.host, args.port, args.cache_tiles)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+import hashlib
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from build_train_and_calculateloss import build_lstm_model
+
+_CHECKPOINT_PATTERN = re.compile(r"epoch_(\d+)\.keras$")
+
+
+def current_rss_mib():
+    """Resident set size of this process in MiB (peak RSS where the current value is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KiB on Linux
+        return usage / 1024 ** 2 if platform.system() == "Darwin" else usage / 1024
+
+
+class TrainingInstrumentation(tf.keras.callbacks.Callback):
+    """
+    Records per-epoch throughput, step latency, input wait time and memory to a JSON log.
+
+    Step latency is the time between the start and end of each training batch; data
+    wait is the time between the end of one batch and the start of the next, which is
+    where Keras fetches the next batch from the input pipeline. The log is rewritten
+    after every epoch, so it survives a crash, and a resumed run appends to it.
+
+    Parameters:
+    ----------
+    log_path : str
+        Path of the JSON log.
+    batch_size : int
+        Samples per training batch, used to compute samples/sec.
+    """
+
+    def __init__(self, log_path, batch_size):
+        super().__init__()
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.epochs = []
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                self.epochs = json.load(f)["epochs"]
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._step_times = []
+        self._data_wait = 0.0
+        self._epoch_start = time.perf_counter()
+        self._last_batch_end = self._epoch_start
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._batch_start = time.perf_counter()
+        self._data_wait += self._batch_start - self._last_batch_end
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._last_batch_end = time.perf_counter()
+        self._step_times.append(self._last_batch_end - self._batch_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self._epoch_start
+        step_ms = np.array(self._step_times) * 1000
+        record = {
+            "epoch": epoch + 1,
+            "seconds": round(seconds, 4),
+            "steps": len(step_ms),
+            "samples_per_sec": round(len(step_ms) * self.batch_size / seconds, 1) if seconds else None,
+            "step_ms_p50": round(float(np.percentile(step_ms, 50)), 3) if len(step_ms) else None,
+            "step_ms_p90": round(float(np.percentile(step_ms, 90)), 3) if len(step_ms) else None,
+            "step_ms_p99": round(float(np.percentile(step_ms, 99)), 3) if len(step_ms) else None,
+            "data_wait_seconds": round(self._data_wait, 4),
+            "rss_mib": round(current_rss_mib(), 1),
+            **{name: float(value) for name, value in (logs or {}).items()},
+        }
+        # A resumed run replaces the records of the epochs it repeats
+        self.epochs = [r for r in self.epochs if r["epoch"] < record["epoch"]] + [record]
+
+        directory = os.path.dirname(self.log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.log_path, "w") as f:
+            json.dump({"batch_size": self.batch_size, "epochs": self.epochs}, f, indent=2)
+
+
+class PeriodicCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Saves the full model (weights and optimizer state) every `every` epochs as
+    `epoch_XXXX.keras` in `directory`, keeping only the `keep` most recent files.
+    """
+
+    def __init__(self, directory, every=1, keep=2):
+        super().__init__()
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"epoch_{epoch + 1:04d}.keras")
+        # Write to a temporary name first so an interrupted save never looks like a checkpoint
+        temporary_path = path[:-len(".keras")] + ".tmp.keras"
+        self.model.save(temporary_path)
+        os.replace(temporary_path, path)
+
+        for old_path, _ in list_checkpoints(self.directory)[:-self.keep]:
+            os.remove(old_path)
+
+
+class BestCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Saves the model as `best.keras` in `directory` whenever the validation loss improves,
+    and records its epoch and loss in `best.json`, so a resumed run still knows which
+    epoch was best.
+    """
+
+    def __init__(self, directory, monitor="val_loss"):
+        super().__init__()
+        self.directory = directory
+        self.monitor = monitor
+        self.best = read_best_checkpoint(directory)
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is None or (self.best and current >= self.best["val_loss"]):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "best.keras")
+        temporary_path = os.path.join(self.directory, "best.tmp.keras")
+        self.model.save(temporary_path)
+        os.replace(temporary_path, path)
+
+        self.best = {"epoch": epoch + 1, "val_loss": float(current)}
+        with open(os.path.join(self.directory, "best.json.tmp"), "w") as f:
+            json.dump(self.best, f)
+        os.replace(os.path.join(self.directory, "best.json.tmp"), os.path.join(self.directory, "best.json"))
+
+
+def read_best_checkpoint(directory):
+    """Returns the {"epoch", "val_loss"} record of the best checkpoint in `directory`, or None."""
+    path = os.path.join(directory, "best.json")
+    if not os.path.exists(path) or not os.path.exists(os.path.join(directory, "best.keras")):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_checkpoints(directory):
+    """Returns the (path, epoch) of every checkpoint in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    checkpoints = []
+    for file in os.listdir(directory):
+        match = _CHECKPOINT_PATTERN.match(file)
+        if match:
+            checkpoints.append((os.path.join(directory, file), int(match.group(1))))
+    return sorted(checkpoints, key=lambda checkpoint: checkpoint[1])
+
+
+def latest_checkpoint(directory):
+    """Returns the (path, epoch) of the newest checkpoint in `directory`, or (None, 0)."""
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else (None, 0)
+
+
+def training_fingerprint(sequences, targets, chunk_size=1_000_000, **settings):
+    """
+    Hashes the training arrays and settings, for naming a checkpoint directory.
+
+    The arrays are read in chunks of `chunk_size` rows, so memory-mapped inputs are
+    never loaded whole.
+
+    Parameters:
+    ----------
+    sequences, targets : np.ndarray
+        The training arrays.
+    chunk_size : int, optional
+        Number of rows hashed at a time.
+    **settings :
+        Training settings (epochs, batch size, ...) that change the result.
+
+    Returns:
+    -------
+    str
+        A hex digest.
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode())
+    for array in (sequences, targets):
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        for start in range(0, len(array), chunk_size):
+            digest.update(np.ascontiguousarray(array[start:start + chunk_size]).tobytes())
+    return digest.hexdigest()
+
+
+def autotune_batch_size(input_shape, sequences, targets, candidates=(64, 128, 256, 512, 1024, 2048, 4096),
+                        steps=20, warmup_steps=3, units=50):
+    """
+    Picks the batch size with the highest training throughput on this host.
+
+    Every candidate trains a fresh model for `warmup_steps` untimed steps (graph
+    tracing) followed by `steps` timed `train_on_batch` calls on the first samples.
+
+    Parameters:
+    ----------
+    input_shape : tuple
+        Shape of one input sample (sequence_length, num_features).
+    sequences : np.ndarray
+        Training sequences of shape (n_samples, sequence_length, num_features).
+    targets : np.ndarray
+        Training targets of shape (n_samples,).
+    candidates : iterable of int, optional
+        Batch sizes to try; those larger than the dataset are skipped.
+    steps : int, optional
+        Number of timed steps per candidate.
+    warmup_steps : int, optional
+        Number of untimed steps per candidate.
+    units : int, optional
+        Number of LSTM units of the timed model.
+
+    Returns:
+    -------
+    tuple
+        The best batch size and a dict of batch size -> samples/sec.
+    """
+    throughput = {}
+    for batch_size in candidates:
+        if batch_size > len(targets):
+            continue
+        model = build_lstm_model(input_shape, units)
+        x = np.asarray(sequences[:batch_size])
+        y = np.asarray(targets[:batch_size])
+        for _ in range(warmup_steps):
+            model.train_on_batch(x, y)
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.train_on_batch(x, y)
+        throughput[batch_size] = steps * batch_size / (time.perf_counter() - start)
+        print(f"Batch size {batch_size:>5}: {throughput[batch_size]:,.0f} samples/sec")
+
+    if not throughput:
+        raise ValueError("No candidate batch size fits the training data.")
+    best = max(throughput, key=throughput.get)
+    print(f"Selected batch size: {best}")
+    return best, throughput
+
+
+def train_with_harness(sequences, targets, checkpoint_directory, epochs=50, batch_size=150, validation_split=0.1,
+                       validation_data=None, patience=5, checkpoint_every=1, log_path=None, units=50, resume=True):
+    """
+    Trains the LSTM model with instrumentation, early stopping and checkpoint/resume.
+
+    If `checkpoint_directory` already holds checkpoints, the newest one is loaded and
+    training continues from its epoch; otherwise a new model is built. The directory
+    should be specific to the training data and settings (see `training_fingerprint`).
+    The model of the best epoch is kept as `best.keras` and is what gets returned,
+    also after a resume; a run that had already stopped early trains no more epochs.
+
+    Parameters:
+    ----------
+    sequences : np.ndarray
+        Training sequences of shape (n_samples, sequence_length, num_features).
+    targets : np.ndarray
+        Training targets of shape (n_samples,).
+    checkpoint_directory : str
+        Directory for the periodic checkpoints.
+    epochs : int, optional
+        Maximum number of training epochs.
+    batch_size : int or "auto", optional
+        Samples per batch; "auto" runs `autotune_batch_size` first.
+    validation_split : float, optional
+        Fraction of the samples held out for validation when `validation_data` is not given.
+    validation_data : tuple, optional
+        (sequences, targets) used for validation.
+    patience : int, optional
+        Epochs without improvement of the validation loss before training stops.
+        The weights of the best epoch are restored.
+    checkpoint_every : int, optional
+        Save a checkpoint every this many epochs.
+    log_path : str, optional
+        Path of the JSON training log. Defaults to `training_log.json` in `checkpoint_directory`.
+    units : int, optional
+        Number of LSTM units of a newly built model.
+    resume : bool, optional
+        Continue from the checkpoints in `checkpoint_directory`; when False they are
+        deleted and training starts over.
+
+    Returns:
+    -------
+    tuple
+        The trained model and its `History` object.
+    """
+    input_shape = sequences.shape[1:]
+    if batch_size == "auto":
+        batch_size, _ = autotune_batch_size(input_shape, sequences, targets, units=units)
+
+    if not resume:
+        shutil.rmtree(checkpoint_directory, ignore_errors=True)
+
+    checkpoint_path, initial_epoch = latest_checkpoint(checkpoint_directory)
+    best = read_best_checkpoint(checkpoint_directory)
+    if best and best["epoch"] > initial_epoch:
+        # With checkpoint_every > 1 the best epoch can be newer than the last periodic checkpoint
+        checkpoint_path, initial_epoch = os.path.join(checkpoint_directory, "best.keras"), best["epoch"]
+    if checkpoint_path:
+        print(f"Resuming from {checkpoint_path} (epoch {initial_epoch})")
+        model = tf.keras.models.load_model(checkpoint_path)
+    else:
+        model = build_lstm_model(input_shape, units)
+
+    # A resumed run only gets the patience left since its best epoch, and has to beat its loss
+    remaining_patience = min(patience, patience - (initial_epoch - best["epoch"])) if best else patience
+    if remaining_patience <= 0:
+        print(f"Training already stopped early after epoch {initial_epoch}; best epoch was {best['epoch']}.")
+        epochs = initial_epoch
+
+    callbacks = [
+        TrainingInstrumentation(log_path or os.path.join(checkpoint_directory, "training_log.json"), batch_size),
+        tf.keras.callbacks.EarlyStopping(
+            monitor="val_loss", patience=max(remaining_patience, 1), restore_best_weights=True,
+            baseline=best["val_loss"] if best else None
+        ),
+        BestCheckpoint(checkpoint_directory),
+        PeriodicCheckpoint(checkpoint_directory, every=checkpoint_every),
+    ]
+    history = model.fit(
+        sequences, targets, epochs=epochs, batch_size=batch_size, initial_epoch=initial_epoch,
+        validation_split=0.0 if validation_data is not None else validation_split,
+        validation_data=validation_data, callbacks=callbacks
+    )
+
+    best = read_best_checkpoint(checkpoint_directory)
+    if best:
+        print(f"Loading the best model (epoch {best['epoch']}, val_loss {best['val_loss']:.6f})")
+        model = tf.keras.models.load_model(os.path.join(checkpoint_directory, "best.keras"))
+    return model, history